@@ -0,0 +1,178 @@
+"""
+Benchmarks drawing generation, the optimization stages and SVG previews on the
+drawings in examples.py, each repeated a bunch of times side by side to make
+them large enough to measure. Results are written to a JSON file, and can be
+compared to those of a previous run to spot regressions:
+
+python3 benchmark.py --output before.json
+# change something
+python3 benchmark.py --output after.json --compare before.json
+"""
+
+import io
+import sys
+import json
+import time
+import random
+import statistics
+import argparse
+import platform
+import tracemalloc
+
+import brachiosaurus as bs
+import examples
+
+DRAWINGS = [
+    "spiral_mountain",
+    "spiral_debian",
+    "spiral_rose",
+    "lines_boxes_arcs",
+    "concentric_circles",
+    "spiral_grid",
+    "circle_heart",
+    "spiral_row",
+    "radial_lines",
+    "raidal_lines_interrupted",
+    "concentric_squares",
+    "cog",
+    "trojaborg_labyrinth_1",
+    "trojaborg_labyrinth_2",
+    "wiki_spiral",
+    "overlaid_3dish_balls",
+    "line_circles",
+    "hatched_circle",
+    "ca",
+    "uji",
+    "overlapping_circles",
+    "moire_spirals",
+    ]
+
+def generate(draw, copies, seed):
+    """
+    Draw copies of the drawing next to each other (seeding each one, in case
+    it's random), return the combined lines.
+    """
+
+    lines = bs.Lines()
+    x = 0
+    for n in range(copies):
+        random.seed(seed + n)
+        c = bs.Canvas()
+        draw(c)
+        summary = c.summary
+        copy = bs.transform_lines(c.packed(), (1, 0, x - summary.xmin, 0, 1, 0))
+        base = lines.offsets[-1]
+        lines.coords.extend(copy.coords[0:2 * copy.offsets[-1]])
+        lines.offsets.extend(base + o for o in copy.offsets[1:])
+        x += summary.xmax - summary.xmin + 1
+    return lines
+
+def timed(f, *args, repeat=5):
+    """
+    Run f a few times, return its result and the median wall time of the runs,
+    which is less at the mercy of whatever else is going on than a single one.
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+def peak_memory(f, *args):
+    """Run f, return the peak memory allocated while running it in KiB."""
+
+    tracemalloc.start()
+    try:
+        f(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+def benchmark(name, copies, seed, time_budget):
+    draw = getattr(examples, name)
+    result = {}
+
+    lines, result["generate_s"] = timed(generate, draw, copies, seed)
+    result["generate_peak_kb"] = peak_memory(generate, draw, copies, seed)
+    summary = bs.Summary.of(lines)
+    result["lines"] = summary.lines
+    result["points"] = summary.points
+    result["pen_up"] = summary.pen_up
+
+    def preview(lines):
+        bs.FakePlotter(lines).emit(io.StringIO())
+
+    _, result["preview_s"] = timed(preview, lines)
+    result["preview_peak_kb"] = peak_memory(preview, lines)
+
+    stitched, result["stitch_s"] = timed(bs.stitch_lines, lines)
+    thinned, result["thin_s"] = timed(bs.thin_lines, stitched, 0.01)
+    optimized, result["optimize_s"] = timed(bs.optimize_lines, thinned, time_budget, repeat=1)
+    result["optimized_lines"] = len(optimized)
+    result["optimized_points"] = sum(len(l) for l in optimized)
+    result["optimized_pen_up"] = bs.pen_up_distance(optimized)
+    return result
+
+def compare(results, baseline, threshold, floor):
+    """
+    Print timings and memory peaks that got worse than in baseline by more
+    than the given factor, return whether there were any. Timings that got
+    worse by less than floor seconds are ignored, since they're within the
+    noise for quick runs.
+    """
+
+    regressions = False
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            if not metric.endswith(("_s", "_peak_kb")):
+                continue
+            before = baseline.get(name, {}).get(metric)
+            if metric.endswith("_s") and before is not None and value - before < floor:
+                continue
+            if before and value > before * threshold:
+                print(f"{name} {metric}: {before:.4g} -> {value:.4g}", file=sys.stderr)
+                regressions = True
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--output", default="benchmark.json", help="file to write results to")
+    parser.add_argument("--compare", help="results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown factor considered a regression")
+    parser.add_argument("--floor", type=float, default=0.01, help="slowdown in seconds below which timings aren't compared")
+    parser.add_argument("--copies", type=int, default=10, help="number of copies of each drawing")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--time-budget", type=float, default=1, help="time budget of the line order optimization")
+    parser.add_argument("drawings", nargs="*", default=DRAWINGS, help="drawings to benchmark")
+    args = parser.parse_args()
+
+    # the optimization stages report their results on stderr, which would
+    # drown out everything else
+    debug = bs.debug
+    bs.debug = lambda msg: None
+    results = {}
+    for name in args.drawings:
+        results[name] = benchmark(name, args.copies, args.seed, args.time_budget)
+        debug(f"{name}: {results[name]['points']} points, generated in {results[name]['generate_s']:.3f}s")
+    bs.debug = debug
+
+    with open(args.output, "w") as f:
+        json.dump(dict(
+            python=platform.python_version(),
+            machine=platform.machine(),
+            date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            copies=args.copies,
+            seed=args.seed,
+            results=results
+            ), f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold, args.floor):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,32 @@
+import os
 import sys
 import math
+import copy
 import json
+import queue
+import time
+import random
+import pickle
+import hashlib
+import inspect
+import mmap
+import marshal
 import socket
+import struct
+import atexit
+import bisect
+import operator
+import threading
+import functools
+import itertools
+from array import array
+
+# numpy speeds up cropping if available, but isn't required since it's not
+# exactly quick to install on a Raspberry Pi
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 PI_HOSTNAME = "raspberrypi"
 BG_CONFIG = dict(
@@ -19,40 +44,1977 @@ BG_CONFIG = dict(
     pw_down=1200
     )
 
-TAU = 2 * math.pi
+# how fast the servos turn, in degrees per second – not something the
+# BrachioGraph software needs to know, but trajectories compiled beforehand
+# (see ReplayPlotter) are timed by it, as are plot time estimates
+SERVO_SPEED = 600
+
+# drawings generated via Canvas.cached are stored here, with the least
+# recently used ones evicted once they take up more than this many bytes
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "brachiosaurus")
+CACHE_SIZE = 256 * 2 ** 20
+
+# cached drawings are stored untransformed, followed by the transformation
+# pending on their canvas, the position of its pen and whether the last line is
+# still in progress, see Canvas.cached
+_CACHE_TRAILER = struct.Struct("<8d?")
+
+TAU = 2 * math.pi
+
+def debug(msg):
+    """since stdout will be redirected into a file some of the time, printing
+    of debug info to stderr is useful every once in a while"""
+
+    sys.stderr.write(f"{msg}\n")
+
+class Profile:
+    """
+    Records the number of calls, wall time and number of points (drawn by
+    canvas primitives, or resulting from plotter stages) of the functions
+    marked with profiled. Active while used as a context manager, reporting on
+    stderr when left – or for the whole run if the BRACHIOSAURUS_PROFILE
+    environment variable is set. Times include those of nested profiled
+    calls, e.g. circles are counted as arcs, too.
+    """
+
+    active = None
+
+    def __init__(self):
+        self.stats = {}
+
+    def __enter__(self):
+        self.__outer = Profile.active
+        Profile.active = self
+        return self
+
+    def __exit__(self, *exc):
+        Profile.active = self.__outer
+        self.report()
+
+    def record(self, name, seconds, points):
+        stats = self.stats.setdefault(name, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += points
+
+    def report(self):
+        for name, (calls, seconds, points) in sorted(self.stats.items(), key=lambda s: -s[1][1]):
+            debug(f"profile: {name}: {calls} calls, {seconds:.3f}s, {points} points")
+
+def _points(x):
+    """Number of points of a canvas, a plotter's drawing or lines."""
+
+    if isinstance(x, Canvas):
+        # not from its buffer, which is emptied as lines are streamed, see
+        # Canvas.stream
+        return x.summary.points
+    if isinstance(x, Plotter):
+        x = x.lines
+    if isinstance(x, Lines):
+        return x.offsets[-1]
+    return sum(map(len, x))
+
+def profiled(drawing=False):
+    """
+    Decorator marking a method for profiling (see Profile), which records the
+    points of its result (or, if that's None, its object) or, for drawing
+    methods, the points they added. Unless profiling, the only overhead is a
+    check whether it is.
+    """
+
+    def decorate(f):
+        name = f.__qualname__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            profile = Profile.active
+            if profile is None:
+                return f(*args, **kwargs)
+            before = _points(args[0]) if drawing else 0
+            start = time.perf_counter()
+            result = f(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            profile.record(name, seconds, _points(args[0] if result is None else result) - before)
+            return result
+        return wrapper
+    return decorate
+
+if os.environ.get("BRACHIOSAURUS_PROFILE"):
+    Profile.active = Profile()
+    atexit.register(Profile.active.report)
+
+class Lines:
+    """
+    Compact representation of a drawing: the coordinates of all points live in
+    a single flat buffer (x0, y0, x1, y1, ...), the lines are delimited by a
+    buffer of offsets (counted in points, starting with 0) into it. Apart from
+    that, instances behave like the equivalent list of lists of points.
+    """
+
+    def __init__(self, coords=None, offsets=None):
+        self.coords = array("d") if coords is None else coords
+        self.offsets = array("q", [0]) if offsets is None else offsets
+
+    @classmethod
+    def pack(cls, lines):
+        """Pack a list of lines, which is returned as-is if already packed."""
+
+        if isinstance(lines, Lines):
+            return lines
+        packed = cls()
+        for l in lines:
+            packed.append(l)
+        return packed
+
+    def append(self, line):
+        self.coords.extend(c for p in line for c in p)
+        self.offsets.append(len(self.coords) // 2)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __line(self, i):
+        coords = iter(self.coords[2 * self.offsets[i]:2 * self.offsets[i + 1]])
+        return [[x, y] for x, y in zip(coords, coords)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.__line(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("line index out of range")
+        return self.__line(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.__line(i)
+
+    def tolist(self):
+        # converting all coordinates at once is much faster than line by line
+        coords = self.coords[0:2 * self.offsets[-1]].tolist()
+        points = list(map(list, zip(coords[0::2], coords[1::2])))
+        return list(map(points.__getitem__, map(slice, self.offsets, self.offsets[1:])))
+
+    def endpoints(self):
+        """Yield (first point, last point) of each line."""
+
+        coords = self.coords
+        for start, end in zip(self.offsets, self.offsets[1:]):
+            yield ([coords[2 * start], coords[2 * start + 1]],
+                   [coords[2 * end - 2], coords[2 * end - 1]])
+
+class InstancedLines:
+    """
+    Lines among which motifs are placed (see Canvas.place), each a drawing of
+    its own. Placements are given as (position, motif, matrix) triples, where
+    the motif's lines are transformed by matrix and inserted before the line
+    at position. Motifs are only expanded while iterating, so memory usage
+    doesn't grow with the number of times they're placed.
+    """
+
+    def __init__(self, lines, placements):
+        self.lines = lines
+        self.placements = placements
+
+    def parts(self):
+        """
+        Yield the drawing in order, as (None, line) for lines and as (motif,
+        matrix) for placements.
+        """
+
+        placements = iter(self.placements)
+        placement = next(placements, None)
+        for i, l in enumerate(self.lines):
+            while placement is not None and placement[0] <= i:
+                yield placement[1:]
+                placement = next(placements, None)
+            yield None, l
+        while placement is not None:
+            yield placement[1:]
+            placement = next(placements, None)
+
+    def transform(self, matrix):
+        """Transform lines and placements, the latter without expanding them."""
+
+        return InstancedLines(
+            transform_lines(self.lines, matrix),
+            [(i, motif, compose(m, matrix)) for i, motif, m in self.placements]
+            )
+
+    def __len__(self):
+        return len(self.lines) + sum(len(motif) for _, motif, _ in self.placements)
+
+    def __iter__(self):
+        for motif, item in self.parts():
+            if motif is None:
+                yield item
+            else:
+                yield from transform_lines(motif, item)
+
+    def tolist(self):
+        return list(self)
+
+def endpoints(lines):
+    """Yield (first point, last point) of each line without unpacking it."""
+
+    if isinstance(lines, Lines):
+        return lines.endpoints()
+    return ((l[0], l[-1]) for l in lines)
+
+def pen_up_distance(lines):
+    """
+    Sum of the distances the pen travels while lifted, i.e. between the end of
+    each line and the start of the next one.
+    """
+
+    ends = list(endpoints(lines))
+    return sum(math.dist(a[1], b[0]) for a, b in zip(ends, ends[1:]))
+
+class Summary:
+    """
+    Geometry statistics of a drawing (bounding box, number of points and lines,
+    length of drawn lines and of pen movements between them), updated line by
+    line as the drawing grows so that no line needs to be looked at twice.
+    """
+
+    def __init__(self):
+        self.xmin = self.ymin = math.inf
+        self.xmax = self.ymax = -math.inf
+        self.points = 0
+        self.lines = 0
+        self.drawn = 0
+        self.pen_up = 0
+        self.start = None
+        self.end = None
+
+    @classmethod
+    def of(cls, lines):
+        """Summarize an existing drawing."""
+
+        summary = cls()
+        for l in lines:
+            summary.add(l)
+        return summary
+
+    def add(self, line):
+        """Account for another line."""
+
+        xs = [p[0] for p in line]
+        ys = [p[1] for p in line]
+        drawn = sum(math.dist(p, q) for p, q in zip(line, line[1:]))
+        self.add_stats(line[0], line[-1], len(line), min(xs), min(ys), max(xs), max(ys), drawn)
+
+    def add_coords(self, coords, start, end):
+        """
+        Account for another line, given as the points from start to end (not
+        included) of a flat coordinate buffer, see Lines.
+        """
+
+        xs = coords[2 * start:2 * end:2]
+        ys = coords[2 * start + 1:2 * end:2]
+        drawn = sum(map(math.hypot, map(operator.sub, xs[1:], xs), map(operator.sub, ys[1:], ys)))
+        self.add_stats((xs[0], ys[0]), (xs[-1], ys[-1]), end - start, min(xs), min(ys), max(xs), max(ys), drawn)
+
+    def add_stats(self, first, last, points, xmin, ymin, xmax, ymax, drawn):
+        """Account for another line, given its precomputed statistics."""
+
+        self.xmin = min(self.xmin, xmin)
+        self.ymin = min(self.ymin, ymin)
+        self.xmax = max(self.xmax, xmax)
+        self.ymax = max(self.ymax, ymax)
+        self.points += points
+        self.lines += 1
+        self.drawn += drawn
+        if self.end is not None:
+            self.pen_up += math.dist(self.end, first)
+        if self.start is None:
+            self.start = first
+        self.end = last
+
+    def add_summary(self, other):
+        """Account for another drawing, drawn after this one."""
+
+        if not other.lines:
+            return
+        self.xmin = min(self.xmin, other.xmin)
+        self.ymin = min(self.ymin, other.ymin)
+        self.xmax = max(self.xmax, other.xmax)
+        self.ymax = max(self.ymax, other.ymax)
+        self.points += other.points
+        self.lines += other.lines
+        self.drawn += other.drawn
+        self.pen_up += other.pen_up
+        if self.end is not None and other.start is not None:
+            self.pen_up += math.dist(self.end, other.start)
+        if self.start is None:
+            self.start = other.start
+        self.end = other.end
+
+    def transformed(self, matrix):
+        """
+        Summary of the drawing after an affine transformation (see IDENTITY),
+        without looking at its lines: the bounding box is that of the
+        transformed corners, and lengths are scaled by the largest factor the
+        matrix stretches anything by – both of which are exact for everything
+        but rotations and uneven scalings, where they err on the large side.
+        """
+
+        summary = copy.copy(self)
+        if not self.lines:
+            return summary
+
+        a, b, c, d, e, f = matrix
+        corners = [(x, y) for x in (self.xmin, self.xmax) for y in (self.ymin, self.ymax)]
+        xs = [a * x + b * y + c for x, y in corners]
+        ys = [d * x + e * y + f for x, y in corners]
+        summary.xmin, summary.ymin, summary.xmax, summary.ymax = min(xs), min(ys), max(xs), max(ys)
+
+        # the largest singular value of the linear part
+        squares = a * a + b * b + d * d + e * e
+        det = a * e - b * d
+        stretch = math.sqrt((squares + math.sqrt(max(squares * squares - 4 * det * det, 0))) / 2)
+        summary.drawn *= stretch
+        summary.pen_up *= stretch
+        if self.start is not None:
+            x, y = self.start
+            summary.start = (a * x + b * y + c, d * x + e * y + f)
+        if self.end is not None:
+            x, y = self.end
+            summary.end = (a * x + b * y + c, d * x + e * y + f)
+        return summary
+
+    def bbox(self):
+        """Bounding box in the format [xmin, ymin, xmax, ymax]."""
+
+        return [self.xmin, self.ymin, self.xmax, self.ymax]
+
+    def within(self, bounds):
+        """Whether the drawing lies within bounds, see bbox for the format."""
+
+        xmin, ymin, xmax, ymax = bounds
+        return xmin <= self.xmin and self.xmax <= xmax and ymin <= self.ymin and self.ymax <= ymax
+
+    def __repr__(self):
+        return (f"{self.lines} lines, {self.points} points, bounding box {self.bbox()}, "
+                f"drawn length {self.drawn:.2f}, pen-up length {self.pen_up:.2f}")
+
+class _Grid:
+    """
+    Buckets points (given as a dict mapping ids to (x, y) pairs) into the cells
+    of a uniform grid, which makes looking up the points near some location
+    cheap. Points can be added and removed, the grid coarsens itself as it
+    empties and is rebuilt when points are added outside of it or it's gotten
+    crowded. A margin (relative to the extent of the points) leaves room for
+    points added later.
+    """
+
+    def __init__(self, points, margin=0):
+        self.points = points
+        self.margin = margin
+        self.size = len(points)
+        self.cells = {}
+        if not points:
+            self.cols = self.rows = 0
+            return
+
+        xs = [p[0] for p in points.values()]
+        ys = [p[1] for p in points.values()]
+        self.xmin = min(xs)
+        self.ymin = min(ys)
+        w = max(xs) - self.xmin
+        h = max(ys) - self.ymin
+
+        # aim for about two points per cell
+        n = len(points)
+        self.cell = max(math.sqrt(2 * w * h / n), max(w, h) / n, 1e-9)
+        pad = margin * max(w, h)
+        self.xmin -= pad
+        self.ymin -= pad
+        self.cols = int((w + 2 * pad) / self.cell) + 1
+        self.rows = int((h + 2 * pad) / self.cell) + 1
+        for i, (x, y) in points.items():
+            self.cells.setdefault(self.__key(x, y), set()).add(i)
+
+    def __key(self, x, y):
+        return (int((x - self.xmin) // self.cell), int((y - self.ymin) // self.cell))
+
+    def __ring(self, cx, cy, k):
+        """Keys of the cells at Chebyshev distance k from cell (cx, cy)."""
+
+        if k == 0:
+            yield (cx, cy)
+            return
+        xs = range(max(cx - k, 0), min(cx + k, self.cols - 1) + 1)
+        for y in (cy - k, cy + k):
+            if 0 <= y < self.rows:
+                for x in xs:
+                    yield (x, y)
+        ys = range(max(cy - k + 1, 0), min(cy + k - 1, self.rows - 1) + 1)
+        for x in (cx - k, cx + k):
+            if 0 <= x < self.cols:
+                for y in ys:
+                    yield (x, y)
+
+    def add(self, i, point):
+        self.points[i] = point
+        cx, cy = key = self.__key(*point) if self.cols else (-1, -1)
+        if 0 <= cx < self.cols and 0 <= cy < self.rows and len(self.points) <= 4 * self.size:
+            self.cells.setdefault(key, set()).add(i)
+        else:
+            self.__init__(self.points, self.margin)
+
+    def remove(self, i):
+        cell = self.cells[self.__key(*self.points.pop(i))]
+        cell.discard(i)
+
+        # once most cells are empty, searching for the nearest point would
+        # mostly visit empty cells, so rebuild with a coarser grid
+        if len(self.points) * 8 < len(self.cells):
+            self.__init__(self.points, self.margin)
+
+    def near(self, x, y):
+        """Ids of the points in the cell containing (x, y) and its neighbors."""
+
+        cx, cy = self.__key(x, y)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                yield from self.cells.get((cx + dx, cy + dy), ())
+
+    def nearest(self, x, y):
+        """Id of the point nearest to (x, y), None if the grid is empty."""
+
+        if not self.points:
+            return None
+
+        # rings closer than the grid's edge are empty, which matters for
+        # locations far outside a grid with (nearly) coinciding points
+        cx, cy = self.__key(x, y)
+        start = max(cx - self.cols + 1, -cx, cy - self.rows + 1, -cy, 0)
+        reach = max(cx, self.cols - cx, cy, self.rows - cy)
+        best = None
+        best_d = math.inf
+        for k in range(start, reach + 1):
+            for key in self.__ring(cx, cy, k):
+                for i in self.cells.get(key, ()):
+                    px, py = self.points[i]
+                    d = (px - x) ** 2 + (py - y) ** 2
+                    if d < best_d:
+                        best = i
+                        best_d = d
+
+            # points in ring k + 1 or beyond are at least k cells away
+            if best is not None and best_d <= (k * self.cell) ** 2:
+                break
+        return best
+
+class SpatialIndex:
+    """
+    Index of lines (e.g. those of a canvas or plotter) for finding the ones
+    near some location or within some region without scanning all of them.
+    Lines are identified by their position in the lines the index was built
+    from, inserted ones get the next free ids. Each line is registered in the
+    cells of a uniform grid overlapped by its bounding box – or, if that spans
+    lots of cells, each of its segments in the cells it passes through, using
+    ever coarser grids (with cells twice as large each) for longer segments
+    such that none is registered in too many cells. Endpoints are kept in a
+    separate grid, where nearest neighbors are looked up.
+    """
+
+    # most cells a line's bounding box and a long line's segment may span
+    box_cells = 16
+    segment_cells = 64
+
+    def __init__(self, lines=()):
+        if not isinstance(lines, Lines):
+            lines = Lines.pack(lines)
+        coords = lines.coords
+        self.__lines = {}
+        self.__boxes = {}
+        for i, (start, end) in enumerate(zip(lines.offsets, lines.offsets[1:])):
+            line = array("d", coords[2 * start:2 * end])
+            self.__lines[i] = line
+            self.__boxes[i] = (min(line[0::2]), min(line[1::2]), max(line[0::2]), max(line[1::2]))
+        self.__next = len(lines)
+        self.__build()
+
+    def __build(self):
+        """Pick a cell size suiting the lines and register all of them."""
+
+        self.__built = len(self.__lines)
+        self.__levels = []
+        self.__cell = None
+        self.__ends = _Grid({}, 0.5)
+        if not self.__lines:
+            return
+
+        # cells larger than most lines, such that they're registered in few
+        # cells, but not so small that a sparse drawing's lines end up with
+        # lots of empty cells between them
+        boxes = self.__boxes.values()
+        w = max(b[2] for b in boxes) - min(b[0] for b in boxes)
+        h = max(b[3] for b in boxes) - min(b[1] for b in boxes)
+        n = len(boxes)
+        sides = sorted(max(b[2] - b[0], b[3] - b[1]) for b in boxes)
+        self.__cell = max(2 * sides[n // 2], math.sqrt(w * h / n), max(w, h) / n, 1e-9)
+        for i in self.__lines:
+            self.__register(i)
+
+        points = {}
+        for i, line in self.__lines.items():
+            points[2 * i] = (line[0], line[1])
+            points[2 * i + 1] = (line[-2], line[-1])
+        self.__ends = _Grid(points, 0.5)
+
+    def __registrations(self, i):
+        """
+        Yield (level, cell, entry) for each cell the line is registered in,
+        where entries are the line's id or, for segments of lines with large
+        bounding boxes, (id, index of the segment).
+        """
+
+        cell = self.__cell
+        xmin, ymin, xmax, ymax = self.__boxes[i]
+        xs = range(int(xmin // cell), int(xmax // cell) + 1)
+        ys = range(int(ymin // cell), int(ymax // cell) + 1)
+        if len(xs) * len(ys) <= self.box_cells:
+            for kx in xs:
+                for ky in ys:
+                    yield 0, (kx, ky), i
+            return
+
+        coords = self.__lines[i]
+        for k in range(len(coords) // 2 - 1):
+            x0, y0, x1, y1 = coords[2 * k:2 * k + 4]
+            if x0 > x1:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            level = 0
+            size = cell
+            while abs(x1 - x0) + abs(y1 - y0) > (self.segment_cells - 2) * size:
+                level += 1
+                size *= 2
+
+            # walk the columns the segment passes through, registering the
+            # cells its part within each covers (plus a bit of slack against
+            # rounding errors)
+            slack = size * 1e-9
+            for kx in range(int(x0 // size), int(x1 // size) + 1):
+                if x0 < x1:
+                    ya = y0 + (max(x0, kx * size) - x0) / (x1 - x0) * (y1 - y0)
+                    yb = y0 + (min(x1, (kx + 1) * size) - x0) / (x1 - x0) * (y1 - y0)
+                else:
+                    ya, yb = y0, y1
+                for ky in range(int((min(ya, yb) - slack) // size), int((max(ya, yb) + slack) // size) + 1):
+                    yield level, (kx, ky), (i, k)
+
+    def __register(self, i):
+        levels = self.__levels
+        for level, key, entry in self.__registrations(i):
+            while len(levels) <= level:
+                levels.append({})
+            levels[level].setdefault(key, set()).add(entry)
+
+    def __unregister(self, i):
+        for level, key, entry in self.__registrations(i):
+            entries = self.__levels[level][key]
+            entries.discard(entry)
+            if not entries:
+                del self.__levels[level][key]
+
+    def __candidates(self, xmin, ymin, xmax, ymax):
+        """
+        Map the ids of the lines whose bounding boxes intersect the rectangle
+        to the indices of those of their segments that might, too – or to None
+        if that could be any of them.
+        """
+
+        found = {}
+        big = sys.float_info.max
+        size = self.__cell
+        for cells in self.__levels:
+            x0, y0 = max(xmin, -big) // size, max(ymin, -big) // size
+            x1, y1 = min(xmax, big) // size, min(ymax, big) // size
+            size *= 2
+
+            # large rectangles cover more cells than there are occupied ones
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > len(cells):
+                hits = [entries for (kx, ky), entries in cells.items()
+                        if x0 <= kx <= x1 and y0 <= ky <= y1]
+            else:
+                hits = [cells[kx, ky]
+                        for kx in range(int(x0), int(x1) + 1)
+                        for ky in range(int(y0), int(y1) + 1)
+                        if (kx, ky) in cells]
+
+            for entries in hits:
+                for entry in entries:
+                    if isinstance(entry, tuple):
+                        found.setdefault(entry[0], set()).add(entry[1])
+                    else:
+                        found[entry] = None
+
+        boxes = self.__boxes
+        return {i: segments for i, segments in found.items()
+                if boxes[i][0] <= xmax and xmin <= boxes[i][2]
+                and boxes[i][1] <= ymax and ymin <= boxes[i][3]}
+
+    def __segments(self, i, segments):
+        """
+        Yield the segments of a line with the given indices (all of them if
+        None) as (x0, y0, x1, y1), a single point counting as a segment.
+        """
+
+        coords = self.__lines[i]
+        if len(coords) == 2:
+            yield coords[0], coords[1], coords[0], coords[1]
+            return
+        for k in range(len(coords) // 2 - 1) if segments is None else sorted(segments):
+            yield coords[2 * k], coords[2 * k + 1], coords[2 * k + 2], coords[2 * k + 3]
+
+    def __len__(self):
+        return len(self.__lines)
+
+    def __contains__(self, i):
+        return i in self.__lines
+
+    def __iter__(self):
+        return iter(self.__lines)
+
+    def __getitem__(self, i):
+        coords = iter(self.__lines[i])
+        return [[x, y] for x, y in zip(coords, coords)]
+
+    def insert(self, line):
+        """Add a line, return its id."""
+
+        i = self.__next
+        self.__next += 1
+        coords = array("d", (c for p in line for c in p))
+        self.__lines[i] = coords
+        self.__boxes[i] = (min(coords[0::2]), min(coords[1::2]), max(coords[0::2]), max(coords[1::2]))
+
+        # the cell size is picked for the lines present when building, so once
+        # they've been outnumbered, it's picked anew
+        if self.__cell is None or len(self.__lines) > 2 * self.__built:
+            self.__build()
+        else:
+            self.__register(i)
+            self.__ends.add(2 * i, (coords[0], coords[1]))
+            self.__ends.add(2 * i + 1, (coords[-2], coords[-1]))
+        return i
+
+    def delete(self, i):
+        """Remove the line with the given id."""
+
+        self.__unregister(i)
+        del self.__lines[i]
+        del self.__boxes[i]
+        self.__ends.remove(2 * i)
+        self.__ends.remove(2 * i + 1)
+
+    def nearest(self, x, y):
+        """
+        Return the id of the line with the endpoint nearest to (x, y) along
+        with whether that's its last point (i.e. the line would need to be
+        reversed to continue from there), None if the index is empty.
+        """
+
+        end = self.__ends.nearest(x, y)
+        if end is None:
+            return None
+        return end // 2, end % 2 == 1
+
+    def rect(self, xmin, ymin, xmax, ymax, within=False):
+        """
+        Return the ids of the lines passing through the rectangle – or, if
+        within is set, lying entirely inside of it.
+        """
+
+        result = []
+        for i, segments in self.__candidates(xmin, ymin, xmax, ymax).items():
+            bxmin, bymin, bxmax, bymax = self.__boxes[i]
+            if xmin <= bxmin and bxmax <= xmax and ymin <= bymin and bymax <= ymax:
+                result.append(i)
+                continue
+            if within:
+                continue
+
+            # parametric clipping of each segment against the rectangle, see
+            # crop_lines
+            for x0, y0, x1, y1 in self.__segments(i, segments):
+                dx = x1 - x0
+                dy = y1 - y0
+                t0, t1 = 0, 1
+                for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+                    if p == 0:
+                        if q < 0:
+                            t0 = 2
+                    elif p < 0:
+                        t0 = max(t0, q / p)
+                    else:
+                        t1 = min(t1, q / p)
+                if t0 <= t1:
+                    result.append(i)
+                    break
+        return sorted(result)
+
+    def radius(self, x, y, r):
+        """Return the ids of the lines passing within distance r of (x, y)."""
+
+        result = []
+        for i, segments in self.__candidates(x - r, y - r, x + r, y + r).items():
+            for x0, y0, x1, y1 in self.__segments(i, segments):
+                dx = x1 - x0
+                dy = y1 - y0
+
+                # distance to the point of the segment closest to (x, y)
+                length = dx * dx + dy * dy
+                t = 0 if length == 0 else min(1, max(0, ((x - x0) * dx + (y - y0) * dy) / length))
+                if math.hypot(x0 + t * dx - x, y0 + t * dy - y) <= r:
+                    result.append(i)
+                    break
+        return sorted(result)
+
+def optimize_lines(lines, time_budget=10, reverse=True):
+    """
+    Reorder (and, if reverse is set, flip) lines such that the pen travels as
+    little as possible while lifted. This is a traveling salesman problem, so
+    instead of an optimal solution, a greedy nearest neighbor tour is computed
+    and subsequently refined with 2-opt and Or-opt moves until no improvements
+    are found or the time budget (in seconds) runs out.
+    """
+
+    deadline = time.perf_counter() + time_budget
+    if not isinstance(lines, (list, Lines)):
+        lines = Lines.pack(lines)
+    n = len(lines)
+    if n < 3:
+        # few enough orders to try them all, preferring the original one
+        flips = itertools.product((False, True) if reverse else (False,), repeat=n)
+        result = min(
+            ([lines[line][::-1] if f else lines[line] for line, f in zip(order, flip)]
+             for order, flip in itertools.product(itertools.permutations(range(n)), flips)),
+            key=pen_up_distance
+            )
+        debug(f"optimize: pen-up distance {pen_up_distance(lines):.2f} -> {pen_up_distance(result):.2f}")
+        return result
+
+    # endpoint ids: 2 * i is the start of line i, 2 * i + 1 its end
+    first, last = zip(*endpoints(lines))
+    points = {}
+    for i in range(n):
+        points[2 * i] = first[i]
+        if reverse:
+            points[2 * i + 1] = last[i]
+
+    # greedy nearest neighbor construction
+    order = []
+    rev = [False] * n
+    grid = _Grid(dict(points))
+    i = 0
+    while i is not None:
+        line = i // 2
+        order.append(line)
+        rev[line] = i % 2 == 1
+        grid.remove(2 * line)
+        if reverse:
+            grid.remove(2 * line + 1)
+        i = grid.nearest(*(first if rev[line] else last)[line])
+
+    # refinement, operating on the current orientation of each line
+    def start(line):
+        return last[line] if rev[line] else first[line]
+
+    def end(line):
+        return first[line] if rev[line] else last[line]
+
+    def d(p, q):
+        return math.dist(p, q) if p is not None and q is not None else 0
+
+    def s(k):
+        return start(order[k]) if 0 <= k < n else None
+
+    def e(k):
+        return end(order[k]) if 0 <= k < n else None
+
+    pos = [0] * n
+    for k, line in enumerate(order):
+        pos[line] = k
+
+    def place(lo, hi):
+        for k in range(lo, hi):
+            pos[order[k]] = k
+
+    def candidates(p):
+        """Lines with an endpoint close to p."""
+
+        return {i // 2 for i in nearby.near(*p)}
+
+    def two_opt(a):
+        """Try reversing the stretch after position a, return True on success."""
+
+        if not reverse:
+            return False
+        ea = e(a)
+        for c in candidates(ea):
+            b = pos[c]
+            if b == a:
+                continue
+            i, j = min(a, b), max(a, b)
+            gain = d(e(i), s(i + 1)) + d(e(j), s(j + 1)) - d(e(i), e(j)) - d(s(i + 1), s(j + 1))
+            if gain > 1e-9:
+                order[i + 1:j + 1] = order[j:i:-1]
+                for line in order[i + 1:j + 1]:
+                    rev[line] = not rev[line]
+                place(i + 1, j + 1)
+                return True
+        return False
+
+    def or_opt(a, length):
+        """Try moving the stretch of lines starting at position a elsewhere."""
+
+        if a + length > n:
+            return False
+        sa, ea = s(a), e(a + length - 1)
+        removal = d(e(a - 1), sa) + d(ea, s(a + length)) - d(e(a - 1), s(a + length))
+        if removal <= 1e-9:
+            return False
+        for flip in (False, True) if reverse else (False,):
+            for c in candidates(ea if flip else sa):
+                b = pos[c]
+                if a - 1 <= b < a + length:
+                    continue
+                if flip:
+                    insertion = d(e(b), ea) + d(sa, s(b + 1)) - d(e(b), s(b + 1))
+                else:
+                    insertion = d(e(b), sa) + d(ea, s(b + 1)) - d(e(b), s(b + 1))
+                if removal - insertion > 1e-9:
+                    stretch = order[a:a + length]
+                    if flip:
+                        stretch.reverse()
+                        for line in stretch:
+                            rev[line] = not rev[line]
+                    del order[a:a + length]
+                    k = b + 1 if b < a else b + 1 - length
+                    order[k:k] = stretch
+                    place(min(a, k), max(a, k) + length)
+                    return True
+        return False
+
+    nearby = _Grid(points)
+    improved = True
+    steps = 0
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for a in range(n):
+            moved = two_opt(a)
+            for length in (1, 2, 3):
+                moved = or_opt(a, length) or moved
+            improved = improved or moved
+
+            steps += 1
+            if steps % 256 == 0 and time.perf_counter() >= deadline:
+                break
+
+    result = [lines[line][::-1] if rev[line] else lines[line] for line in order]
+    debug(f"optimize: pen-up distance {pen_up_distance(lines):.2f} -> {pen_up_distance(result):.2f}")
+    return result
+
+def stitch_lines(lines, tolerance=1e-6):
+    """
+    Join lines sharing endpoints (up to the given tolerance) into as few
+    continuous lines as possible. Each line is an edge in a graph whose nodes
+    are the snapped endpoints, the minimum number of trails covering all edges
+    is found by linking the odd-degree nodes to a virtual node, computing an
+    Eulerian circuit with Hierholzer's algorithm and cutting it at the virtual
+    edges.
+    """
+
+    if not isinstance(lines, (list, Lines)):
+        lines = Lines.pack(lines)
+
+    def key(p):
+        return (round(p[0] / tolerance), round(p[1] / tolerance))
+
+    # edge i connects the nodes at the start and end of line i, virtual edges
+    # (connecting the virtual node None to odd-degree nodes) are appended later
+    ends = []
+    adjacent = {}
+    for i, (first, last) in enumerate(endpoints(lines)):
+        a, b = key(first), key(last)
+        ends.append((a, b))
+        adjacent.setdefault(a, []).append(i)
+        adjacent.setdefault(b, []).append(i)
+    real = len(ends)
+    for node in list(adjacent):
+        if len(adjacent[node]) % 2 == 1:
+            ends.append((None, node))
+            adjacent.setdefault(None, []).append(len(ends) - 1)
+            adjacent[node].append(len(ends) - 1)
+
+    def other(edge, node):
+        a, b = ends[edge]
+        return b if a == node else a
+
+    used = [False] * len(ends)
+    trails = []
+
+    def emit_trail(trail):
+        if trail:
+            trails.append(trail)
+
+    # visit the virtual node first so that each trail starts at an odd node
+    for root in sorted(adjacent, key=lambda node: node is not None):
+        if all(used[edge] for edge in adjacent[root]):
+            continue
+
+        # iterative Hierholzer, the circuit is the sequence of (edge, node)
+        # pairs popped off the stack, where edge leads from node to the next
+        # one (the final pair is the root, reached via no edge at all)
+        stack = [(None, root)]
+        circuit = []
+        while stack:
+            _, node = stack[-1]
+            edges = adjacent[node]
+            while edges and used[edges[-1]]:
+                edges.pop()
+            if edges:
+                edge = edges.pop()
+                used[edge] = True
+                stack.append((edge, other(edge, node)))
+            else:
+                circuit.append(stack.pop())
+
+        # split the circuit at virtual edges, orient each line such that it
+        # continues where the previous one ended
+        trail = []
+        for edge, here in circuit[:-1]:
+            if edge >= real:
+                emit_trail(trail)
+                trail = []
+                continue
+            l = lines[edge]
+            if key(l[0]) != here:
+                l = l[::-1]
+            trail.extend(l if not trail else l[1:])
+        emit_trail(trail)
+
+    debug(f"stitch: {len(lines)} lines -> {len(trails)} lines")
+    return trails
+
+def thin_lines(lines, tolerance, chunk=1024):
+    """
+    Drop points that barely contribute to the shape of their line: using the
+    Ramer-Douglas-Peucker algorithm (implemented with an explicit stack, so
+    lines with millions of points are fine), each line is simplified such that
+    it deviates from the original by at most tolerance. Long lines are
+    simplified in chunks of the given number of points, which keeps the
+    algorithm's quadratic worst case at bay.
+    """
+
+    def simplify(l, keep, i, j):
+        """Mark the points of l[i:j + 1] to be kept in keep."""
+
+        stack = [(i, j)]
+        while stack:
+            i, j = stack.pop()
+            ax, ay = l[i]
+            bx, by = l[j]
+            dx = bx - ax
+            dy = by - ay
+            length = dx * dx + dy * dy
+            worst = 0
+            worst_k = None
+            for k in range(i + 1, j):
+                px, py = l[k]
+                if length == 0:
+                    t = 0
+                else:
+                    t = max(0, min(1, ((px - ax) * dx + (py - ay) * dy) / length))
+                d = (px - ax - t * dx) ** 2 + (py - ay - t * dy) ** 2
+                if d > worst:
+                    worst = d
+                    worst_k = k
+            if worst > tolerance ** 2:
+                keep[worst_k] = True
+                stack.append((i, worst_k))
+                stack.append((worst_k, j))
+
+    result = []
+    before = 0
+    after = 0
+    for l in lines:
+        keep = [False] * len(l)
+        for i in range(0, len(l) - 1, chunk):
+            j = min(i + chunk, len(l) - 1)
+            keep[i] = keep[j] = True
+            simplify(l, keep, i, j)
+        thinned = [p for p, k in zip(l, keep) if k] if len(l) > 1 else list(l)
+        result.append(thinned)
+        before += len(l)
+        after += len(thinned)
+
+    debug(f"thin: {before - after} of {before} points removed")
+    return result
+
+def crop_lines(lines, bounds=None):
+    """
+    Crop lines to the rectangle given by bounds (in the [xmin, ymin, xmax,
+    ymax] format used by the BrachioGraph software, defaulting to the bounds
+    configured in BG_CONFIG), splitting lines that leave and reenter it. Lines
+    lying entirely within bounds are kept as-is, all others are clipped segment
+    by segment using the Liang-Barsky algorithm.
+    """
+
+    xmin, ymin, xmax, ymax = bounds or BG_CONFIG["bounds"]
+
+    lines = Lines.pack(lines)
+    if numpy is not None and len(lines):
+        result, clipped = _crop_numpy(lines, xmin, ymin, xmax, ymax)
+        debug(f"crop: {clipped} of {len(lines)} lines clipped")
+        return result
+
+    coords = lines.coords
+    result = Lines()
+    clipped = 0
+    for i, (start, end) in enumerate(zip(lines.offsets, lines.offsets[1:])):
+        xs = coords[2 * start:2 * end:2]
+        ys = coords[2 * start + 1:2 * end:2]
+        if xmin <= min(xs) and max(xs) <= xmax and ymin <= min(ys) and max(ys) <= ymax:
+            result.coords.extend(coords[2 * start:2 * end])
+            result.offsets.append(len(result.coords) // 2)
+            continue
+        clipped += 1
+        l = lines[i]
+
+        def at(x0, y0, dx, dy, t):
+            """
+            Point at parameter t along a segment, which rounding might put
+            just outside bounds otherwise.
+            """
+
+            return [min(max(x0 + t * dx, xmin), xmax), min(max(y0 + t * dy, ymin), ymax)]
+
+        piece = None
+        for (x0, y0), (x1, y1) in zip(l, l[1:]):
+            dx = x1 - x0
+            dy = y1 - y0
+
+            # parametric clipping of the segment against each of the four
+            # boundaries, yielding the visible parameter range [t0, t1]
+            t0 = 0
+            t1 = 1
+            if dx == 0:
+                if x0 < xmin or x0 > xmax:
+                    t0 = 2
+            elif dx > 0:
+                t0 = max(t0, (xmin - x0) / dx)
+                t1 = min(t1, (xmax - x0) / dx)
+            else:
+                t0 = max(t0, (xmax - x0) / dx)
+                t1 = min(t1, (xmin - x0) / dx)
+            if dy == 0:
+                if y0 < ymin or y0 > ymax:
+                    t0 = 2
+            elif dy > 0:
+                t0 = max(t0, (ymin - y0) / dy)
+                t1 = min(t1, (ymax - y0) / dy)
+            else:
+                t0 = max(t0, (ymax - y0) / dy)
+                t1 = min(t1, (ymin - y0) / dy)
+
+            if t0 > t1:
+                if piece:
+                    result.append(piece)
+                piece = None
+                continue
+            if piece is None or t0 > 0:
+                if piece:
+                    result.append(piece)
+                piece = [at(x0, y0, dx, dy, t0) if t0 > 0 else [x0, y0]]
+            piece.append(at(x0, y0, dx, dy, t1) if t1 < 1 else [x1, y1])
+            if t1 < 1:
+                result.append(piece)
+                piece = None
+        if piece:
+            result.append(piece)
+
+    debug(f"crop: {clipped} of {len(lines)} lines clipped")
+    return result
+
+def _crop_numpy(lines, xmin, ymin, xmax, ymax):
+    """
+    Vectorized equivalent of crop_lines, clipping all segments at once and
+    yielding exactly the same result. Returns the cropped lines along with the
+    number of lines that needed clipping.
+    """
+
+    offsets = numpy.asarray(lines.offsets, dtype=numpy.int64)
+    n = int(offsets[-1])
+    points = numpy.asarray(lines.coords, dtype=numpy.float64)[:2 * n].reshape(-1, 2)
+    counts = numpy.diff(offsets)
+
+    # segments start at every point but the last of each line, lines made up
+    # of a single point get a degenerate segment ending where it starts,
+    # which only contributes its start
+    line = numpy.repeat(numpy.arange(len(counts)), counts)
+    single = numpy.zeros(n, dtype=bool)
+    single[offsets[:-1][counts == 1]] = True
+    starts = numpy.ones(n, dtype=bool)
+    starts[offsets[1:][counts > 0] - 1] = False
+    a = numpy.flatnonzero(starts | single)
+    pseudo = single[a]
+    b = a + ~pseudo
+    x0, y0 = points[a, 0], points[a, 1]
+    x1, y1 = points[b, 0], points[b, 1]
+    dx = x1 - x0
+    dy = y1 - y0
+
+    # parametric clipping of all segments against the four boundaries, in
+    # the same order as crop_lines to yield identical parameters
+    t0 = numpy.zeros(len(a))
+    t1 = numpy.ones(len(a))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        for d, p, low, high in ((dx, x0, xmin, xmax), (dy, y0, ymin, ymax)):
+            t0 = numpy.where((d == 0) & ((p < low) | (p > high)), 2, t0)
+            t0 = numpy.where(d > 0, numpy.maximum(t0, (low - p) / d), t0)
+            t1 = numpy.where(d > 0, numpy.minimum(t1, (high - p) / d), t1)
+            t0 = numpy.where(d < 0, numpy.maximum(t0, (high - p) / d), t0)
+            t1 = numpy.where(d < 0, numpy.minimum(t1, (low - p) / d), t1)
+
+    # a visible segment continues the previous one's piece if that reached
+    # its end and this one isn't cut off at its start
+    visible = t0 <= t1
+    segment_line = line[a]
+    follows = numpy.zeros(len(a), dtype=bool)
+    follows[1:] = (visible[:-1] & (t1[:-1] >= 1) & (segment_line[1:] == segment_line[:-1])
+                   & ~pseudo[1:] & ~pseudo[:-1])
+    begins = visible & ~(follows & (t0 <= 0))
+
+    # each visible segment contributes its (clipped) start if it begins a
+    # piece, and its (clipped) end unless it's degenerate – clipped points are
+    # clamped to bounds since rounding might put them just outside
+    v = visible
+    low = [xmin, ymin]
+    high = [xmax, ymax]
+    firsts = numpy.where((t0 > 0)[v, None],
+                         numpy.clip(numpy.stack([x0 + t0 * dx, y0 + t0 * dy], axis=1)[v], low, high),
+                         numpy.stack([x0, y0], axis=1)[v])
+    lasts = numpy.where((t1 < 1)[v, None],
+                        numpy.clip(numpy.stack([x0 + t1 * dx, y0 + t1 * dy], axis=1)[v], low, high),
+                        numpy.stack([x1, y1], axis=1)[v])
+    keep = numpy.stack([begins[v], ~pseudo[v]], axis=1).ravel()
+    cropped = numpy.stack([firsts, lasts], axis=1).reshape(-1, 2)[keep]
+    emitted = numpy.concatenate([[0], numpy.cumsum(begins[v].astype(numpy.int64) + ~pseudo[v])])
+
+    result = Lines()
+    result.coords.frombytes(numpy.ascontiguousarray(cropped, dtype=numpy.float64).tobytes())
+    result.offsets = array("q")
+    result.offsets.frombytes(numpy.append(emitted[:-1][begins[v]], emitted[-1]).astype(numpy.int64).tobytes())
+
+    outside = (points[:, 0] < xmin) | (points[:, 0] > xmax) | (points[:, 1] < ymin) | (points[:, 1] > ymax)
+    clipped = int(numpy.count_nonzero(numpy.diff(line[outside], prepend=-1)))
+    return result, clipped
+
+def dedupe_lines(lines, tolerance=1e-6):
+    """
+    Remove segments, or the parts of them, retracing segments drawn before
+    (give or take tolerance), splitting lines where needed. Segments are
+    bucketed by the angle and the offset (from the center of the drawing) of
+    the infinite line they lie on, both quantized such that they're off by at
+    most tolerance within the drawing's bounding box. Each bucket keeps track
+    of the intervals along its line that have already been drawn, sorted and
+    merged. Segments shorter than tolerance only survive as part of a longer
+    piece, and lines consisting only of such segments (dots) are kept as-is.
+    """
+
+    summary = Summary.of(lines)
+    if not summary.lines:
+        return Lines()
+    cx = (summary.xmin + summary.xmax) / 2
+    cy = (summary.ymin + summary.ymax) / 2
+    r = max(math.hypot(summary.xmax - summary.xmin, summary.ymax - summary.ymin) / 2, tolerance)
+    n = math.ceil(math.pi * r / tolerance)
+    q = math.pi / n
+
+    # the bucket keys are (angle index, offset index), their values two lists
+    # of interval starts and ends measured along the line
+    covered = {}
+
+    def hidden(x0, y0, x1, y1, k):
+        """
+        Parts of the segment (as ranges of its parameter from 0 to 1) already
+        covered in the buckets near angle index k, along with the key and the
+        interval of the bucket it belongs in itself.
+        """
+
+        mx = (x0 + x1) / 2 - cx
+        my = (y0 + y1) / 2 - cy
+        ranges = []
+        for j in (k - 1, k, k + 1):
+            j %= n
+            dx = math.cos(j * q)
+            dy = math.sin(j * q)
+            o = round((dx * my - dy * mx) / tolerance)
+            t0 = dx * (x0 - cx) + dy * (y0 - cy)
+            t1 = dx * (x1 - cx) + dy * (y1 - cy)
+            if j == k:
+                own = ((j, o), min(t0, t1), max(t0, t1))
+            lo = min(t0, t1)
+            hi = max(t0, t1)
+            for p in (o - 1, o, o + 1):
+                bucket = covered.get((j, p))
+                if bucket is None:
+                    continue
+                starts, ends = bucket
+                i = bisect.bisect_left(ends, lo)
+                while i < len(starts) and starts[i] <= hi:
+                    a = (starts[i] - t0) / (t1 - t0)
+                    b = (ends[i] - t0) / (t1 - t0)
+                    ranges.append((max(min(a, b), 0), min(max(a, b), 1)))
+                    i += 1
+        return ranges, own
+
+    def cover(key, lo, hi):
+        """Add the interval [lo, hi] to a bucket, merging overlapping ones."""
+
+        starts, ends = covered.setdefault(key, ([], []))
+        i = bisect.bisect_left(ends, lo)
+        j = bisect.bisect_right(starts, hi)
+        if i < j:
+            lo = min(lo, starts[i])
+            hi = max(hi, ends[j - 1])
+        starts[i:j] = [lo]
+        ends[i:j] = [hi]
+
+    result = []
+    before = 0
+    after = 0
+    for l in lines:
+        piece = None
+        dot = True
+        for (x0, y0), (x1, y1) in zip(l, l[1:]):
+            length = math.hypot(x1 - x0, y1 - y0)
+            before += length
+            if length <= tolerance:
+                pieces = [(0, 1)] if piece else []
+            else:
+                dot = False
+                k = round(math.atan2(y1 - y0, x1 - x0) % math.pi / q) % n
+                ranges, (key, lo, hi) = hidden(x0, y0, x1, y1, k)
+                cover(key, lo, hi)
+
+                # the complement of the covered ranges, ignoring slivers
+                # shorter than tolerance either way
+                pieces = []
+                s = 0
+                for a, b in sorted(ranges):
+                    if (b - a) * length <= tolerance:
+                        continue
+                    if (a - s) * length > tolerance:
+                        pieces.append((s, a))
+                    s = max(s, b)
+                if (1 - s) * length > tolerance:
+                    pieces.append((s, 1))
+
+            if not pieces or pieces[0][0] > 0:
+                piece = None
+            for a, b in pieces:
+                end = [x1, y1] if b == 1 else [x0 + b * (x1 - x0), y0 + b * (y1 - y0)]
+                if a > 0 or piece is None:
+                    start = [x0, y0] if a == 0 else [x0 + a * (x1 - x0), y0 + a * (y1 - y0)]
+                    piece = [start]
+                    result.append(piece)
+                piece.append(end)
+                after += (b - a) * length
+                if b < 1:
+                    piece = None
+        if dot:
+            result.append(list(l))
+            after += sum(math.dist(p, q) for p, q in zip(l, l[1:]))
+
+    debug(f"dedupe: drawn length {before:.2f} -> {after:.2f} ({before - after:.2f} saved), "
+          f"{summary.lines} lines -> {len(result)} lines")
+    return Lines.pack(result)
+
+# affine transformations are 3x3 matrices whose last row is always (0, 0, 1),
+# they're stored as their first two rows (a, b, c, d, e, f) and map (x, y) to
+# (a * x + b * y + c, d * x + e * y + f)
+IDENTITY = (1, 0, 0, 0, 1, 0)
+
+def compose(first, then):
+    """The matrix applying matrix first, then matrix then."""
+
+    a1, b1, c1, d1, e1, f1 = first
+    a, b, c, d, e, f = then
+    return (
+        a * a1 + b * d1, a * b1 + b * e1, a * c1 + b * f1 + c,
+        d * a1 + e * d1, d * b1 + e * e1, d * c1 + e * f1 + f
+        )
+
+def transform_lines(lines, matrix):
+    """
+    Apply an affine transformation to all points in a single pass. Packed lines
+    are transformed into new packed lines without unpacking them, instanced
+    ones without expanding their motifs.
+    """
+
+    if matrix == IDENTITY:
+        return lines
+    if isinstance(lines, InstancedLines):
+        return lines.transform(matrix)
+    a, b, c, d, e, f = matrix
+    if not isinstance(lines, Lines):
+        return [[[a * x + b * y + c, d * x + e * y + f] for x, y in l] for l in lines]
+
+    n = 2 * lines.offsets[-1]
+    xs = lines.coords[0:n:2]
+    ys = lines.coords[1:n:2]
+    coords = array("d", bytes(8 * n))
+    coords[0::2] = array("d", [a * x + b * y + c for x, y in zip(xs, ys)])
+    coords[1::2] = array("d", [d * x + e * y + f for x, y in zip(xs, ys)])
+    return Lines(coords, array("q", lines.offsets))
+
+class Transformable:
+    """
+    Mixin for composing rotations, mirrorings, scalings and translations into
+    a single matrix, which is applied to the drawing only once it's needed.
+    """
+
+    matrix = IDENTITY
+
+    def transform(self, a, b, c, d, e, f):
+        """Apply the given matrix (see IDENTITY) after all previous ones."""
+
+        self.matrix = compose(self.matrix, (a, b, c, d, e, f))
+        return self
+
+    def translate(self, dx, dy):
+        """Shift the drawing by dx and dy."""
+
+        return self.transform(1, 0, dx, 0, 1, dy)
+
+    def scale(self, sx, sy=None, cx=0, cy=0):
+        """
+        Scale the drawing by sx horizontally and sy (defaulting to sx)
+        vertically, keeping point (cx, cy) in place.
+        """
+
+        if sy is None:
+            sy = sx
+        return self.transform(sx, 0, cx - sx * cx, 0, sy, cy - sy * cy)
+
+    def rotate(self, a, cx=0, cy=0):
+        """Rotate the drawing by angle a (in radians) around point (cx, cy)."""
+
+        cos = math.cos(a)
+        sin = math.sin(a)
+        return self.transform(
+            cos, -sin, cx - cos * cx + sin * cy,
+            sin, cos, cy - sin * cx - cos * cy
+            )
+
+    def mirror(self, x=None, y=None):
+        """
+        Mirror the drawing along the vertical line at x and/or the horizontal
+        line at y.
+        """
+
+        if x is not None:
+            self.transform(-1, 0, 2 * x, 0, 1, 0)
+        if y is not None:
+            self.transform(1, 0, 0, 0, -1, 2 * y)
+        return self
+
+    def fit(self, bounds=None):
+        """
+        Scale the drawing uniformly and move it to the center of bounds (which
+        default to the bounds configured in BG_CONFIG) such that it's as large
+        as possible while staying within them and the arms' reach, see
+        validate_lines. If the arms can't reach the center, the drawing is
+        moved to wherever within bounds it can be largest instead. Needs a
+        summary of the drawing, as canvases and plotters have.
+        """
+
+        summary = self.summary
+        if not summary.points:
+            return self
+
+        # bounding box of the drawing as transformed so far, which is exact for
+        # everything but rotations, where it errs on the safe side
+        xmin, ymin, xmax, ymax = summary.transformed(self.matrix).bbox()
+        w = xmax - xmin
+        h = ymax - ymin
+
+        bounds = bounds or BG_CONFIG["bounds"]
+        bxmin, bymin, bxmax, bymax = bounds
+        largest = min((bxmax - bxmin) / w if w else math.inf, (bymax - bymin) / h if h else math.inf)
+        if largest == math.inf:
+            largest = 1
+
+        def fitting(cx, cy):
+            """
+            The largest safe scale with the drawing centered at (cx, cy), or
+            None if there's none.
+            """
+
+            def safe(scale):
+                return _safe(cx - scale * w / 2, cy - scale * h / 2, cx + scale * w / 2, cy + scale * h / 2, bounds)
+
+            # shrinking the drawing around its center only ever brings it
+            # closer to being safe, so the largest safe scale can be found by
+            # bisection
+            if safe(largest):
+                return largest
+            if not safe(0):
+                return None
+            low = 0
+            high = largest
+            for _ in range(64):
+                mid = (low + high) / 2
+                if safe(mid):
+                    low = mid
+                else:
+                    high = mid
+            return low
+
+        cx = (bxmin + bxmax) / 2
+        cy = (bymin + bymax) / 2
+        scale = fitting(cx, cy)
+        if scale is None:
+            # try centers on a grid spanning bounds, then on ever finer grids
+            # around the best one so far
+            best = None
+            dx = (bxmax - bxmin) / 16
+            dy = (bymax - bymin) / 16
+            centers = [(bxmin + i * dx, bymin + j * dy) for i in range(17) for j in range(17)]
+            for _ in range(6):
+                for x, y in centers:
+                    s = fitting(x, y)
+                    if s is not None and (best is None or s > best[0]):
+                        best = (s, x, y)
+                if best is None:
+                    raise ValueError("bounds are out of the arms' reach")
+                scale, cx, cy = best
+                dx /= 4
+                dy /= 4
+                centers = [(cx + i * dx, cy + j * dy) for i in range(-4, 5) for j in range(-4, 5)]
+
+        # a hair of slack keeps rounding errors from pushing the drawing's
+        # edges past those of bounds
+        scale *= 1 - 1e-9
+        return (self.translate(-(xmin + xmax) / 2, -(ymin + ymax) / 2)
+                    .scale(scale)
+                    .translate(cx, cy))
+
+def iter_json(f, chunk_size=65536):
+    """
+    Incrementally parse a drawing in the JSON format exported by UJI or used by
+    the BrachioGraph software from file object f, yielding one line at a time.
+    Only the line currently being parsed is held in memory.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+
+    def more(size):
+        nonlocal buffer, pos
+        chunk = f.read(size)
+        if not chunk:
+            raise ValueError("unexpected end of JSON drawing")
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip():
+        """Skip whitespace, return the next character."""
+
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            more(chunk_size)
+
+    if skip() != "[":
+        raise ValueError("JSON drawing must be an array of lines")
+    pos += 1
+    if skip() == "]":
+        return
+    while True:
+        # an incomplete line fails to parse, in which case more is read (with
+        # doubling reads so that huge lines don't get reparsed too often)
+        skip()
+        size = chunk_size
+        while True:
+            try:
+                line, pos = decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError:
+                more(size)
+                size = max(size, len(buffer))
+        yield line
+
+        c = skip()
+        pos += 1
+        if c == "]":
+            return
+        if c != ",":
+            raise ValueError(f"unexpected {c!r} in JSON drawing")
+
+def write_json(lines, f, precision=None):
+    """
+    Write lines to file object f in the JSON format used by UJI and the
+    BrachioGraph software, one line at a time. If precision is given,
+    coordinates are rounded to this many decimal places to save space.
+    """
+
+    def fmt(c):
+        return repr(c if precision is None else round(c, precision))
+
+    f.write("[")
+    for n, l in enumerate(lines):
+        f.write(",\n" if n else "\n")
+        f.write("[" + ",".join(f"[{fmt(x)},{fmt(y)}]" for x, y in l) + "]")
+    f.write("\n]\n")
+
+# binary drawing format: a header (magic number, format version, typecode of
+# the coordinates, number of lines and points, summary statistics), then the
+# line offsets (see Lines) as 64-bit integers, then the coordinates as 32-bit
+# or 64-bit floats, all little-endian. Servo trajectories (see
+# compile_trajectory) are stored the same way, but with a magic number of their
+# own, such that they aren't mistaken for drawings and vice versa
+BINARY_MAGIC = b"BRACHIO\0"
+TRAJECTORY_MAGIC = b"BRACHIOT"
+BINARY_HEADER = struct.Struct("<8sHc5xqq6d")
+
+def write_binary(lines, filename, typecode="d", magic=BINARY_MAGIC):
+    """
+    Write lines to a file in the compact binary format, with coordinates stored
+    as doubles (typecode "d") or, halving the file size, floats ("f").
+    """
+
+    lines = Lines.pack(lines)
+    summary = Summary.of(lines)
+    n = lines.offsets[-1]
+    offsets = array("q", lines.offsets)
+    coords = array(typecode, lines.coords[0:2 * n])
+    if sys.byteorder != "little":
+        offsets.byteswap()
+        coords.byteswap()
+    with open(filename, "wb") as f:
+        f.write(BINARY_HEADER.pack(
+            magic, 1, typecode.encode(), len(lines), n,
+            *summary.bbox(), summary.drawn, summary.pen_up
+            ))
+        offsets.tofile(f)
+        coords.tofile(f)
+
+def read_binary(filename, magic=BINARY_MAGIC):
+    """
+    Memory-map a drawing (or, given TRAJECTORY_MAGIC, a servo trajectory) in
+    the binary format, returning its lines (which are only read from disk once
+    accessed) and their summary.
+    """
+
+    with open(filename, "rb") as f:
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if len(data) < BINARY_HEADER.size or data[:len(magic)] != magic:
+        kind = "trajectory" if magic == TRAJECTORY_MAGIC else "drawing"
+        raise ValueError(f"{filename} isn't a {kind} in the binary format")
+    magic, version, typecode, n_lines, n_points, *stats = BINARY_HEADER.unpack(data[:BINARY_HEADER.size])
+    if version != 1:
+        raise ValueError(f"{filename} uses an unsupported version of the binary format")
+
+    start = BINARY_HEADER.size
+    end = start + 8 * (n_lines + 1)
+    typecode = typecode.decode()
+    offsets = data[start:end].cast("q")
+    coords = data[end:end + 2 * n_points * struct.calcsize(typecode)].cast(typecode)
+    if sys.byteorder != "little":
+        offsets = array("q", offsets)
+        offsets.byteswap()
+        coords = array(typecode, coords)
+        coords.byteswap()
+
+    summary = Summary()
+    summary.xmin, summary.ymin, summary.xmax, summary.ymax, summary.drawn, summary.pen_up = stats
+    summary.lines = n_lines
+    summary.points = n_points
+    return Lines(coords, offsets), summary
+
+def json_to_binary(json_filename, binary_filename, typecode="d"):
+    """
+    Convert a drawing in the JSON format exported by UJI or used by the
+    BrachioGraph software into the binary format, then make sure that reading
+    it back yields the same drawing (up to float precision if typecode is "f").
+    """
+
+    with open(json_filename, "r") as f:
+        lines = Lines.pack(iter_json(f))
+    write_binary(lines, binary_filename, typecode)
+
+    converted, _ = read_binary(binary_filename)
+    expected = array(typecode, lines.coords[0:2 * lines.offsets[-1]])
+    if list(converted.offsets) != list(lines.offsets) or converted.coords != expected:
+        raise ValueError(f"round trip from {json_filename} to {binary_filename} doesn't match")
+
+def xy_to_angles(xs, ys):
+    """
+    Inverse kinematics of the BrachioGraph configured in BG_CONFIG, mirroring
+    the computation done by the BrachioGraph software, for many points at once:
+    returns the shoulder and elbow angles (in degrees) for the given lists of x
+    and y coordinates. Raises a ValueError if any point is out of reach.
+    """
+
+    inner = BG_CONFIG["inner_arm"]
+    outer = BG_CONFIG["outer_arm"]
+    try:
+        hs = [math.hypot(x, y) for x, y in zip(xs, ys)]
+        hypotenuse_angles = [math.asin(x / h) for x, h in zip(xs, hs)]
+        inner_angles = [math.acos((h * h + inner * inner - outer * outer) / (2 * h * inner)) for h in hs]
+        outer_angles = [math.acos((inner * inner + outer * outer - h * h) / (2 * inner * outer)) for h in hs]
+    except (ValueError, ZeroDivisionError):
+        raise ValueError("drawing contains points out of the arms' reach")
+    shoulder = [math.degrees(a - b) for a, b in zip(hypotenuse_angles, inner_angles)]
+    elbow = [math.degrees(math.pi - a) for a in outer_angles]
+    return shoulder, elbow
+
+def _safe(xmin, ymin, xmax, ymax, bounds):
+    """
+    Whether all of the rectangle lies within bounds and within reach of the
+    arms, i.e. in the annulus around the shoulder between the difference and
+    the sum of their lengths.
+    """
 
-def debug(msg):
-    """since stdout will be redirected into a file some of the time, printing
-    of debug info to stderr is useful every once in a while"""
+    bxmin, bymin, bxmax, bymax = bounds
+    if not (bxmin <= xmin and xmax <= bxmax and bymin <= ymin and ymax <= bymax):
+        return False
 
-    sys.stderr.write(f"{msg}\n")
+    # the rectangle's farthest point from the shoulder is one of its corners,
+    # its nearest one is the shoulder clamped to it
+    far = math.hypot(max(abs(xmin), abs(xmax)), max(abs(ymin), abs(ymax)))
+    near = math.hypot(min(max(0, xmin), xmax), min(max(0, ymin), ymax))
+    inner = BG_CONFIG["inner_arm"]
+    outer = BG_CONFIG["outer_arm"]
+    return 0 < near and abs(inner - outer) <= near and far <= inner + outer
+
+def validate_lines(lines, bounds=None):
+    """
+    Return the indices of the lines that leave bounds (defaulting to the bounds
+    configured in BG_CONFIG) or the arms' reach. The bounding box of the whole
+    drawing is checked first, then those of individual lines, and only for
+    lines whose bounding box isn't entirely safe, each of their points.
+    """
+
+    bounds = bounds or BG_CONFIG["bounds"]
+    inner = BG_CONFIG["inner_arm"]
+    outer = BG_CONFIG["outer_arm"]
+
+    lines = Lines.pack(lines)
+    n = 2 * lines.offsets[-1]
+    if not n:
+        return []
+    xs = lines.coords[0:n:2]
+    ys = lines.coords[1:n:2]
+    if _safe(min(xs), min(ys), max(xs), max(ys), bounds):
+        return []
+
+    bad = []
+    for i, (start, end) in enumerate(zip(lines.offsets, lines.offsets[1:])):
+        lxs = xs[start:end]
+        lys = ys[start:end]
+        xmin, ymin, xmax, ymax = min(lxs), min(lys), max(lxs), max(lys)
+        if _safe(xmin, ymin, xmax, ymax, bounds):
+            continue
+
+        # the bounding box is exact as far as bounds are concerned, but not
+        # so for reach
+        bxmin, bymin, bxmax, bymax = bounds
+        if xmin < bxmin or xmax > bxmax or ymin < bymin or ymax > bymax:
+            bad.append(i)
+            continue
+        hs = list(map(math.hypot, lxs, lys))
+        near = min(hs)
+        if near == 0 or near < abs(inner - outer) or max(hs) > inner + outer:
+            bad.append(i)
+    return bad
+
+def angles_to_pulse_widths(shoulder, elbow):
+    """
+    Convert lists of shoulder and elbow angles (see xy_to_angles) into servo
+    pulse widths, the way the BrachioGraph software does by default.
+    """
+
+    c1 = BG_CONFIG["servo_1_centre"]
+    c2 = BG_CONFIG["servo_2_centre"]
+    a1 = BG_CONFIG["arm_1_centre"]
+    a2 = BG_CONFIG["arm_2_centre"]
+    ms1 = BG_CONFIG.get("servo_1_degree_ms", -10)
+    ms2 = BG_CONFIG.get("servo_2_degree_ms", 10)
+    return ([c1 + (a - a1) * ms1 for a in shoulder],
+            [c2 + (a - a2) * ms2 for a in elbow])
+
+def compile_trajectory(lines, tolerance=1):
+    """
+    Convert lines into strokes of servo pulse widths (integer microseconds, as
+    [pw_1, pw_2] pairs) for the BrachioGraph configured in BG_CONFIG. Straight
+    segments are curves in joint space, so segments are subdivided wherever
+    the pulse widths at their midpoint deviate from the average of the pulse
+    widths at their ends by more than tolerance. Consecutive points mapping to
+    the same pulse widths are dropped.
+    """
+
+    strokes = []
+    for l in lines:
+        points = [tuple(p) for p in l]
+        pws = list(zip(*angles_to_pulse_widths(*xy_to_angles(*zip(*points)))))
+
+        # subdivide level by level, only rechecking the halves of segments
+        # that were split at the previous level
+        check = [True] * (len(points) - 1)
+        for _ in range(16):
+            todo = [k for k, c in enumerate(check) if c]
+            if not todo:
+                break
+            mids = [((points[k][0] + points[k + 1][0]) / 2, (points[k][1] + points[k + 1][1]) / 2) for k in todo]
+            mid_pws = zip(*angles_to_pulse_widths(*xy_to_angles(*zip(*mids))))
+            split = {}
+            for k, mid, (pw_1, pw_2) in zip(todo, mids, mid_pws):
+                error = max(abs(pw_1 - (pws[k][0] + pws[k + 1][0]) / 2),
+                            abs(pw_2 - (pws[k][1] + pws[k + 1][1]) / 2))
+                if error > tolerance:
+                    split[k] = (mid, (pw_1, pw_2))
+
+            refined_points = []
+            refined_pws = []
+            check = []
+            for k in range(len(points) - 1):
+                refined_points.append(points[k])
+                refined_pws.append(pws[k])
+                if k in split:
+                    refined_points.append(split[k][0])
+                    refined_pws.append(split[k][1])
+                    check += [True, True]
+                else:
+                    check.append(False)
+            points = refined_points + points[-1:]
+            pws = refined_pws + pws[-1:]
 
-class Plotter:
+        stroke = []
+        for pw_1, pw_2 in pws:
+            pw = [round(pw_1), round(pw_2)]
+            if not stroke or pw != stroke[-1]:
+                stroke.append(pw)
+        strokes.append(stroke)
+    return strokes
+
+class Plotter(Transformable):
     """Common plotting interface."""
 
+    # whether lines is a stream consumed while emitting, see from_stream
+    streaming = False
+
     def __init__(self, lines):
         self.lines = lines
 
+    @property
+    def lines(self):
+        return self.__lines
+
+    @lines.setter
+    def lines(self, lines):
+        self.__lines = lines
+        self.__summary = None
+
+    @property
+    def summary(self):
+        """
+        Statistics of the drawing (see Summary), computed at most once unless
+        the lines change.
+        """
+
+        if self.__summary is None:
+            if self.streaming:
+                raise ValueError("streamed drawings aren't known in advance")
+            self.__summary = Summary.of(self.lines)
+        return self.__summary
+
     @classmethod
-    def from_canvas(cls, canvas):
-        return cls(canvas.emit())
+    def from_canvas(cls, canvas, crop=False, stitch=False, thin=None, optimize=False, dedupe=False):
+        plotter = cls(canvas.packed())
+        plotter.__summary = canvas.summary
+        plotter.matrix = canvas.matrix
+        return plotter.__prepare(crop, dedupe, stitch, thin, optimize)
 
     @classmethod
-    def from_file(cls, filename):
-        with open(filename, "r") as f:
-            return cls(json.load(f))
+    @profiled()
+    def from_file(cls, filename, crop=False, stitch=False, thin=None, optimize=False, dedupe=False):
+        """
+        Load a drawing in the binary format (see write_binary) or the JSON
+        format supported by UJI and the BrachioGraph software.
+        """
+
+        with open(filename, "rb") as f:
+            magic = f.read(len(BINARY_MAGIC))
+        if magic == TRAJECTORY_MAGIC:
+            raise ValueError(f"{filename} is a compiled trajectory, which only a ReplayPlotter can plot")
+        if magic == BINARY_MAGIC:
+            lines, summary = read_binary(filename)
+        else:
+            lines = Lines()
+            summary = Summary()
+            with open(filename, "r") as f:
+                for l in iter_json(f):
+                    lines.append(l)
+                    summary.add(l)
+        plotter = cls(lines)
+        plotter.__summary = summary
+        return plotter.__prepare(crop, dedupe, stitch, thin, optimize)
+
+    @classmethod
+    def from_stream(cls, lines, bounds=None):
+        """
+        Plot lines (typically generated by Canvas.stream) as they arrive, while
+        later ones are still being drawn. Since the drawing isn't known in
+        advance, there's no summary, and stages other than transformations
+        aren't available. Previews show the area given by bounds, which default
+        to the bounds configured in BG_CONFIG.
+        """
 
+        plotter = cls(lines)
+        plotter.streaming = True
+        plotter.bounds = bounds or BG_CONFIG["bounds"]
+        return plotter
+
+    def __prepare(self, crop, dedupe, stitch, thin, optimize):
+        """Run the optimization stages requested via from_canvas/from_file."""
+
+        if crop:
+            self.crop(None if crop is True else crop)
+        if dedupe:
+            self.dedupe()
+        if stitch:
+            self.stitch()
+        if thin is not None:
+            self.thin(thin)
+        if optimize:
+            self.optimize()
+        return self
+
+    @profiled()
     def emit(self):
         """Useless dummy implementation."""
 
-        print(self.lines)
+        self.apply_transform()
+        print(list(self.lines))
+
+    def save(self, filename, precision=None):
+        """
+        Save the drawing (after applying any pending transformations) to a
+        JSON file, see write_json.
+        """
+
+        self.apply_transform()
+        with open(filename, "w") as f:
+            write_json(self.lines, f, precision)
+
+    def compile(self, filename, tolerance=1):
+        """
+        Compile the drawing into a servo trajectory (see compile_trajectory)
+        and save it to a file in the binary format, ready to be plotted by a
+        ReplayPlotter.
+        """
+
+        self.apply_transform()
+        write_binary(compile_trajectory(self.lines, tolerance), filename, "f", TRAJECTORY_MAGIC)
+
+    @profiled()
+    def apply_transform(self):
+        """
+        Apply the pending transformations to the lines. This happens
+        automatically before emitting the drawing or running any other stage.
+        """
+
+        if self.matrix != IDENTITY:
+            if self.streaming:
+                matrix = self.matrix
+                self.lines = (transform_lines([l], matrix)[0] for l in self.lines)
+            else:
+                self.lines = transform_lines(self.lines, self.matrix)
+            self.matrix = IDENTITY
+        return self
+
+    @profiled()
+    def validate(self, bounds=None):
+        """
+        Make sure the drawing stays within bounds, which default to the bounds
+        configured in BG_CONFIG, and the arms' reach, raising a ValueError
+        listing the offending lines otherwise, see validate_lines.
+        """
+
+        self.apply_transform()
+        bad = validate_lines(self.lines, bounds)
+        if bad:
+            shown = ", ".join(map(str, bad[:10])) + (", ..." if len(bad) > 10 else "")
+            raise ValueError(f"{len(bad)} lines out of bounds or the arms' reach (see crop or fit): {shown}")
+        return self
+
+    @profiled()
+    def crop(self, bounds=None):
+        """
+        Crop the drawing to bounds, which default to the bounds configured in
+        BG_CONFIG, see crop_lines.
+        """
+
+        self.apply_transform()
+        self.lines = crop_lines(self.lines, bounds)
+        return self
 
-    # TODO could implement several optimizations
-    # TODO optimize? ideally: reorder list of lines such that sum of distances between end and start points is minimal. equivalent to tsp => np-complete. could implement a basic variant where a start point that coincide with the end point of another line leads to the two lines being drawn one after the other, this removing the need for pen movement (this would make the hand-coded variant of the trojaborg labyrinth example obsolete)
-    # TODO thin_lines? compute average distance of points in all lines. points within a line that lie closer to their predecessor than this value are culled. ?
-    # TODO crop? optional xrange and yrange args, crop to these ranges (i.e. split crossing lines intelligently) in emit
-    # TODO rotate?
-    # TODO mirror?
+    @profiled()
+    def dedupe(self, tolerance=1e-6):
+        """
+        Remove (parts of) segments retracing ones drawn before, see
+        dedupe_lines.
+        """
+
+        self.apply_transform()
+        self.lines = dedupe_lines(self.lines, tolerance)
+        return self
+
+    @profiled()
+    def stitch(self, tolerance=1e-6):
+        """
+        Join lines with coinciding endpoints to minimize pen lifts, see
+        stitch_lines.
+        """
+
+        self.apply_transform()
+        self.lines = stitch_lines(self.lines, tolerance)
+        return self
+
+    @profiled()
+    def thin(self, tolerance):
+        """
+        Simplify the lines such that they deviate from the original drawing by
+        at most tolerance, see thin_lines.
+        """
+
+        self.apply_transform()
+        self.lines = thin_lines(self.lines, tolerance)
+        return self
+
+    @profiled()
+    def optimize(self, time_budget=10, reverse=True):
+        """
+        Reorder (and flip, unless reverse is False) the lines to minimize pen
+        movements between them, see optimize_lines.
+        """
+
+        self.apply_transform()
+        self.lines = optimize_lines(self.lines, time_budget, reverse)
+        return self
 
 class RealPlotter(Plotter):
     """BrachiGraph plotting interface."""
@@ -68,63 +2030,173 @@ class RealPlotter(Plotter):
         # these settings work for my brachiograph
         self.bg = BrachioGraph(**BG_CONFIG)
 
+    @profiled()
     def emit(self):
-        self.bg.plot_lines(self.lines)
+        self.apply_transform()
+        if not self.streaming:
+            self.validate()
+            self.bg.plot_lines(list(self.lines))
+            return
+
+        # plot_lines needs to know the whole drawing beforehand, so this
+        # replicates what it does for each line, making sure it can be plotted
+        # before starting on it
+        here = None
+        for i, l in enumerate(self.lines):
+            if validate_lines([l]):
+                self.bg.park()
+                raise ValueError(f"line {i} out of bounds or the arms' reach (see fit)")
+            x, y = l[0]
+            if here != (round(x, 1), round(y, 1)):
+                self.bg.xy(x, y)
+            for x, y in l[1:]:
+                self.bg.xy(x, y, draw=True)
+            here = (round(x, 1), round(y, 1))
+        self.bg.park()
 
     def demo(self):
         """Just for testing whether the BrachioGraph is functioning."""
 
         self.bg.grid_lines(interpolate=400, both=True)
 
+class ReplayPlotter(RealPlotter):
+    """
+    BrachioGraph plotting interface for trajectories compiled beforehand (see
+    Plotter.compile), which should be loaded with from_file. Since lines are
+    strokes of servo pulse widths here, no inverse kinematics or interpolation
+    need to happen while plotting, but transformations and other stages don't
+    make sense either.
+    """
+
+    @classmethod
+    @profiled()
+    def from_file(cls, filename):
+        """Load a trajectory saved by Plotter.compile."""
+
+        lines, _ = read_binary(filename, TRAJECTORY_MAGIC)
+        return cls(lines)
+
+    @profiled()
+    def emit(self):
+        # the servos are given as much time as they need to travel between
+        # consecutive pulse widths, see SERVO_SPEED
+        us_per_second = SERVO_SPEED * abs(BG_CONFIG.get("servo_1_degree_ms", -10))
+        pen = self.bg.pen
+
+        # travel starts at the parking position, where the BrachioGraph
+        # software puts the arms at their centre angles, with the pen up – it
+        # only comes down once the arms have arrived at the start of a stroke
+        # (even if that's where they already are), and is only lifted between
+        # strokes that don't continue one another
+        pen.up()
+        self.bg.park()
+        here = (BG_CONFIG["servo_1_centre"], BG_CONFIG["servo_2_centre"])
+        down = False
+        for stroke in self.lines:
+            for n, (pw_1, pw_2) in enumerate(stroke):
+                if n == 0 and down and (pw_1, pw_2) != here:
+                    pen.up()
+                    down = False
+                self.bg.set_pulse_widths(pw_1, pw_2)
+                time.sleep(max(abs(pw_1 - here[0]), abs(pw_2 - here[1])) / us_per_second)
+                here = (pw_1, pw_2)
+                if not down:
+                    pen.down()
+                    down = True
+        pen.up()
+        self.bg.park()
+
 class FakePlotter(Plotter):
     """SVG-emitting plotting interface."""
 
     def __init__(self, lines):
         super().__init__(lines)
 
-    def emit(self):
+    # above this many points, only a sample of them is annotated
+    detail_threshold = 2000
+
+    @profiled()
+    def emit(self, file=None, detailed=None):
         """
-        Emits an annotated (set detailed = False to generate a boring variant)
-        preview of the drawing on stdout. Colors mean the following:
+        Writes an annotated preview of the drawing to file (stdout by default),
+        one element at a time. Set detailed to False to generate a boring
+        variant, or to True to annotate every single point (by default, that's
+        only done for small drawings, larger ones get a sample of annotations).
+        Colors mean the following:
         Yellow: pen movements when not drawing.
         Blue: Line number.
         Purple: Line segement number.
         Green: Line starting point.
         Red: Line segment point.
         """
-        detailed = True
+
+        self.apply_transform()
+        (file or sys.stdout).writelines(self.svg(detailed))
+
+    def svg(self, detailed=None):
+        """Generates the preview emitted by emit piece by piece."""
+
+        instanced = isinstance(self.lines, InstancedLines)
+        if (self.streaming or instanced) and detailed is None:
+            detailed = False
+        points = self.summary.points if detailed is None else 0
+        every = max(1, math.ceil(points / self.detail_threshold))
 
         x, y, w, h = self.__viewbox()
         stroke = min(w, h) / 500
 
-        svg = f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{x} {y} {w} {h}" style="fill: none; stroke: black; stroke-width: {stroke}px;">\n'
-        if detailed:
-            svg += f'<path d="M0,0'
+        yield f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{x} {y} {w} {h}" style="fill: none; stroke: black; stroke-width: {stroke}px;">\n'
+        if detailed is False:
+            def path(l):
+                x, y = l[0]
+                yield f'<path d="M{x},{y}'
+                for x, y in l[1:]:
+                    yield f' L{x},{y}'
+                yield '" />\n'
+
+            # placed motifs are defined as symbols once, then referenced
+            symbols = {}
+            for motif, item in self.lines.parts() if instanced else ((None, l) for l in self.lines):
+                if motif is None:
+                    yield from path(item)
+                    continue
+                if id(motif) not in symbols:
+                    symbols[id(motif)] = f"motif{len(symbols)}"
+                    yield f'<symbol id="{symbols[id(motif)]}" style="overflow: visible;">\n'
+                    for l in motif:
+                        yield from path(l)
+                    yield '</symbol>\n'
+                # the transformation scales the stroke as well, which the
+                # stroke width (inherited by the symbol's paths) makes up for
+                a, b, c, d, e, f = item
+                width = stroke / math.sqrt(abs(a * e - b * d) or 1)
+                yield f'<use href="#{symbols[id(motif)]}" transform="matrix({a} {d} {b} {e} {c} {f})" style="stroke-width: {width}px;" />\n'
+            yield "</svg>\n"
+            return
+
+        # annotating a point closes the path drawn so far and starts a new one
+        count = 0
+        yield '<path d="M0,0'
         for n, l in enumerate(self.lines):
             x, y = l[0]
-            if detailed:
-                svg += f' L{x},{y}" style="stroke: rgba(255,255,0,0.5); stroke-width: {stroke/2}px;" />\n'
-                svg += f'<text x="{x}" y="{y}" style="font-size: {5*stroke}px; stroke: none; fill: rgba(0,0,255,0.5);">{n}</text>\n'
-                svg += f'<circle cx="{x}" cy="{y}" r="{2*stroke}" style="stroke: none; fill: rgba(0,255,0,0.5);" />\n'
-                svg += f'<path d="M{x},{y}'
-                for m, p in enumerate(l[1:]):
-                    x, y = p
-                    svg += f' L{x},{y}" />\n'
-                    svg += f'<text x="{x}" y="{y}" style="font-size: {5*stroke}px; stroke: none; fill: rgba(128,128,255,0.5);">{n}~{m}</text>\n'
-                    svg += f'<circle cx="{x}" cy="{y}" r="{2*stroke}" style="stroke: none; fill: rgba(255,0,0,0.5);" />\n'
-                    svg += f'<path d="M{x},{y}'
-                svg += f'" />\n'
-                svg += f'<path d="M{x},{y}'
-            else:
-                svg += f'<path d="M{x},{y}'
-                for p in l[1:]:
-                    x, y = p
-                    svg += f' L{x},{y}'
-                svg += f'" />\n'
-        if detailed:
-            svg += f' L{0},{0}" style="stroke: rgba(255,255,0,0.5); stroke-width: {stroke/2}px;" />\n'
-        svg += "</svg>\n"
-        print(svg)
+            yield f' L{x},{y}" style="stroke: rgba(255,255,0,0.5); stroke-width: {stroke/2}px;" />\n'
+            if count % every == 0:
+                yield f'<text x="{x}" y="{y}" style="font-size: {5*stroke}px; stroke: none; fill: rgba(0,0,255,0.5);">{n}</text>\n'
+                yield f'<circle cx="{x}" cy="{y}" r="{2*stroke}" style="stroke: none; fill: rgba(0,255,0,0.5);" />\n'
+            count += 1
+            yield f'<path d="M{x},{y}'
+            for m, (x, y) in enumerate(l[1:]):
+                yield f' L{x},{y}'
+                if count % every == 0:
+                    yield '" />\n'
+                    yield f'<text x="{x}" y="{y}" style="font-size: {5*stroke}px; stroke: none; fill: rgba(128,128,255,0.5);">{n}~{m}</text>\n'
+                    yield f'<circle cx="{x}" cy="{y}" r="{2*stroke}" style="stroke: none; fill: rgba(255,0,0,0.5);" />\n'
+                    yield f'<path d="M{x},{y}'
+                count += 1
+            yield '" />\n'
+            yield f'<path d="M{x},{y}'
+        yield f' L{0},{0}" style="stroke: rgba(255,255,0,0.5); stroke-width: {stroke/2}px;" />\n'
+        yield "</svg>\n"
 
     def __viewbox(self):
         """
@@ -132,22 +2204,89 @@ class FakePlotter(Plotter):
         in the format (xmin, ymin, width, height) reqired by the SVG viewBox
         attribute."""
 
-        xmin = self.lines[0][0][0]
-        xmax = self.lines[0][0][0]
-        ymin = self.lines[0][0][1]
-        ymax = self.lines[0][0][1]
-        for l in self.lines:
-            for p in l:
-                if p[0] < xmin:
-                    xmin = p[0]
-                if p[0] > xmax:
-                    xmax = p[0]
-                if p[1] < ymin:
-                    ymin = p[1]
-                if p[1] > ymax:
-                    ymax = p[1]
+        xmin, ymin, xmax, ymax = self.bounds if self.streaming else self.summary.bbox()
         return (xmin, ymin, xmax - xmin, ymax - ymin)
 
+class SimulatedPlotter(Plotter):
+    """
+    Plot time estimating plotting interface: models the BrachioGraph configured
+    in BG_CONFIG (arm geometry, servo travel, wait times, pen movements) to
+    figure out how long plotting the drawing would take, without any hardware.
+    """
+
+    # parameters of the model not covered by BG_CONFIG: seconds per pen
+    # movement, servo speed in degrees per second (see SERVO_SPEED), and the
+    # interpolate argument of BrachioGraph.plot_lines, which determines the
+    # fraction of the wait time spent after each move
+    pen_transition = 0.25
+    servo_speed = SERVO_SPEED
+    interpolate = 10
+
+    def estimate(self):
+        """
+        Returns a dict holding the estimated time (in seconds) spent drawing,
+        traveling with the pen lifted, and lifting and lowering the pen, their
+        total, and the number of pen lifts.
+        """
+
+        self.apply_transform()
+        wait = BG_CONFIG["wait"]
+        settle = 1 + 1 / self.interpolate
+
+        def move_times(xs0, ys0, xs1, ys1):
+            """Durations of the moves from points 0 to points 1."""
+
+            s0, e0 = xy_to_angles(xs0, ys0)
+            s1, e1 = xy_to_angles(xs1, ys1)
+            return [
+                max(settle * wait * math.hypot(x1 - x0, y1 - y0),
+                    max(abs(a1 - a0), abs(b1 - b0)) / self.servo_speed)
+                for x0, y0, x1, y1, a0, b0, a1, b1 in zip(xs0, ys0, xs1, ys1, s0, e0, s1, e1)
+                ]
+
+        # the arms start and end in their parking position with the pen up,
+        # which is lowered for the first line and afterwards only lifted if
+        # the next line doesn't start where the last one ended (to within a
+        # millimeter, like the BrachioGraph software does)
+        here = [-BG_CONFIG["inner_arm"], BG_CONFIG["outer_arm"]]
+        park = here
+        drawing = 0
+        travels = []
+        lifts = 0
+        for n, l in enumerate(self.lines):
+            xs = [p[0] for p in l]
+            ys = [p[1] for p in l]
+            drawing += sum(move_times(xs, ys, xs[1:], ys[1:]))
+            moved = (round(here[0], 1), round(here[1], 1)) != (round(xs[0], 1), round(ys[0], 1))
+            if moved:
+                travels.append((here, l[0]))
+            if moved or n == 0:
+                lifts += 1
+            here = l[-1]
+        travels.append((here, park))
+
+        froms = [t[0] for t in travels]
+        tos = [t[1] for t in travels]
+        travel = sum(move_times(
+            [p[0] for p in froms], [p[1] for p in froms],
+            [p[0] for p in tos], [p[1] for p in tos]
+            ))
+        pen = 2 * lifts * self.pen_transition
+        return dict(
+            total=drawing + travel + pen,
+            drawing=drawing,
+            travel=travel,
+            pen=pen,
+            lifts=lifts
+            )
+
+    @profiled()
+    def emit(self):
+        e = self.estimate()
+        print(f"estimated plot time: {e['total'] / 60:.1f} min "
+              f"(drawing {e['drawing'] / 60:.1f} min, pen-up travel {e['travel'] / 60:.1f} min, "
+              f"{e['lifts']} pen lifts {e['pen'] / 60:.1f} min)")
+
 def AutoPlotter():
     """
     Determines whether to actually-plot or fake-plot the drawing. This would be
@@ -161,25 +2300,443 @@ def AutoPlotter():
     else:
         return FakePlotter
 
-class Canvas:
-    """Easel not included."""
+def _cache_key(draw, args, kwargs, seed, tolerance):
+    """
+    Hash of everything a drawing generated by Canvas.cached depends on: the
+    source code of the drawing function and of this library, the arguments
+    and the seed. None if the arguments can't be serialized (like generators),
+    in which case the drawing can't be cached.
+    """
+
+    try:
+        arguments = pickle.dumps((args, sorted(kwargs.items()), seed, tolerance), protocol=4)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
 
-    def __init__(self):
-        self.lines = []
+    h = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    try:
+        h.update(inspect.getsource(draw).encode())
+    except OSError:
+        # defined interactively, so there's only the compiled code to go by
+        h.update(marshal.dumps(draw.__code__))
+    h.update(arguments)
+    return h.hexdigest()
+
+def _evict_cache(directory, size):
+    """
+    Delete the least recently used drawings in the cache directory until they
+    take up at most size bytes.
+    """
+
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".bin"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(e[1] for e in entries)
+    for _, entry_size, path in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # evicted by another process in the meantime
+        total -= entry_size
+
+class Instance(Transformable):
+    """A motif placed within a canvas, see Canvas.place."""
+
+    def __init__(self, motif):
+        self.motif = motif
+
+class _StreamClosed(Exception):
+    """Raised inside drawing code once nobody's consuming its stream anymore."""
+
+class Canvas(Transformable):
+    """
+    Easel not included. Transformations (see Transformable) apply to the whole
+    drawing, they take effect when it's emitted – except when streaming, see
+    stream.
+    """
+
+    def __init__(self, tolerance=None):
+        # default maximum deviation of curves from their ideal shape, see arc
+        self.tolerance = tolerance
+
+        # finished lines are stored compactly, see Lines, while the current
+        # line is a plain list of coordinates (x0, y0, x1, y1, ...), which is
+        # cheaper to append to. Lines finished since they were last needed
+        # packed are kept in such lists, too, until then, see __pack
+        self.coords = array("d")
+        self.offsets = array("q", [0])
+        self.__finished = []
+        self.__line = [0, 0]
         self.x = 0
         self.y = 0
-        self.current_line = [[0, 0]]
 
+        # statistics of the finished lines, which are only brought up to date
+        # (from the first line not summarized yet on) once they're needed, such
+        # that drawing doesn't pay for them
+        self.__summary = Summary()
+        self.__summarized = 0
+
+        # if set, finished lines are handed to this function instead of being
+        # kept, see stream
+        self.__sink = None
+
+        # motifs placed so far, as (number of lines before, Instance), see place
+        self.__placements = []
+
+    @classmethod
+    def from_lines(cls, lines, summary=None, tolerance=None):
+        """
+        Create a canvas containing the given lines (whose summary can be passed
+        along if known), positioned at the end of the last one. Drawing on
+        from there begins a new line.
+        """
+
+        lines = Lines.pack(lines)
+        n = lines.offsets[-1]
+        canvas = cls(tolerance)
+        canvas.coords = array("d", lines.coords[0:2 * n])
+        canvas.offsets = array("q", lines.offsets)
+        if summary is not None:
+            canvas.__summary = copy.copy(summary)
+            canvas.__summary.start = tuple(canvas.coords[0:2]) if n else None
+            canvas.__summary.end = tuple(canvas.coords[-2:]) if n else None
+            canvas.__summarized = len(lines)
+        canvas.__begin(*(canvas.coords[-2:] if n else (0, 0)))
+        return canvas
+
+    @classmethod
+    def cached(cls, draw, *args, seed=None, tolerance=None, **kwargs):
+        """
+        Create a canvas and draw on it with draw(canvas, *args, **kwargs), after
+        seeding the random module with seed (if given) – unless that's been
+        done before, then the drawing is loaded from the cache in CACHE_DIR.
+        Drawings are identified by the source code of draw and this library,
+        the arguments and the seed, so draw shouldn't depend on anything else
+        (like unseeded randomness, global variables or helper functions that
+        might change). Either way, the canvas ends up with the same lines
+        (including the one in progress, which drawing continues), pending
+        transformations and pen position, and the state of the random module
+        is left as it was. Arguments that can't be serialized (see
+        _cache_key) bypass the cache.
+        """
+
+        key = _cache_key(draw, args, kwargs, seed, tolerance)
+        filename = os.path.join(CACHE_DIR, key + ".bin") if key is not None else None
+        if filename is not None:
+            try:
+                lines, summary = read_binary(filename)
+                with open(filename, "rb") as f:
+                    f.seek(-_CACHE_TRAILER.size, os.SEEK_END)
+                    *matrix, x, y, unfinished = _CACHE_TRAILER.unpack(f.read())
+            except (OSError, ValueError, struct.error):
+                pass
+            else:
+                # mark as recently used, see _evict_cache
+                os.utime(filename)
+                canvas = cls.from_lines(lines, None if unfinished else summary, tolerance)
+                canvas.matrix = tuple(matrix)
+                if unfinished:
+                    start = 2 * canvas.offsets[-2]
+                    canvas.__line = canvas.coords[start:].tolist()
+                    del canvas.coords[start:]
+                    del canvas.offsets[-1]
+                    canvas.x = x
+                    canvas.y = y
+                else:
+                    canvas.__begin(x, y)
+                return canvas
+
+        canvas = cls(tolerance)
+        state = random.getstate()
+        try:
+            if seed is not None:
+                random.seed(seed)
+            draw(canvas, *args, **kwargs)
+        finally:
+            random.setstate(state)
+        if filename is None:
+            return canvas
+
+        # the line still in progress is stored as the last one, to be taken up
+        # again when loading
+        lines = canvas.lines
+        unfinished = canvas.__current() > 1
+        if unfinished:
+            line = canvas.__line
+            if isinstance(lines, Lines):
+                n = lines.offsets[-1]
+                lines = Lines(lines.coords[0:2 * n] + array("d", line),
+                              lines.offsets + array("q", [n + len(line) // 2]))
+            else:
+                lines = itertools.chain(lines, [list(map(list, zip(line[0::2], line[1::2])))])
+
+        # written under a temporary name first such that other processes never
+        # read half-written files
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        partial = f"{filename}.{os.getpid()}.tmp"
+        write_binary(lines, partial)
+        with open(partial, "ab") as f:
+            f.write(_CACHE_TRAILER.pack(*canvas.matrix, canvas.x, canvas.y, unfinished))
+        os.replace(partial, filename)
+        _evict_cache(CACHE_DIR, CACHE_SIZE)
+        return canvas
+
+    @classmethod
+    def stream(cls, draw, *args, tolerance=None, buffer=256, **kwargs):
+        """
+        Run draw(canvas, *args, **kwargs) on a new canvas in a background
+        thread, yielding each line (transformed, as a list of points) as soon as
+        it's finished rather than keeping it around, so memory usage stays flat
+        no matter how long the drawing gets. Drawing pauses while buffer lines
+        are waiting to be consumed, and stops if the generator is closed. Since
+        lines are gone by the time drawing is done, transformations of the
+        canvas need to happen before the first line is finished – changing
+        them afterwards raises a ValueError.
+        """
+
+        lines = queue.Queue(buffer)
+        closed = threading.Event()
+        done = object()
+
+        def put(item):
+            while True:
+                try:
+                    lines.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    if closed.is_set():
+                        raise _StreamClosed()
+
+        def produce():
+            canvas = cls(tolerance)
+            fixed = []
+
+            def check():
+                if fixed and canvas.matrix != fixed[0]:
+                    raise ValueError("streamed canvases can't be transformed once drawing has begun")
+
+            def sink(line):
+                check()
+                if not fixed:
+                    fixed.append(canvas.matrix)
+                put(transform_lines([line], canvas.matrix)[0])
+
+            canvas.__sink = sink
+            try:
+                draw(canvas, *args, **kwargs)
+                canvas.packed()
+                check()
+                put(done)
+            except _StreamClosed:
+                pass
+            except BaseException as e:
+                try:
+                    put(e)
+                except _StreamClosed:
+                    pass
+
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                item = lines.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            closed.set()
+
+    def __current(self):
+        """Number of points in the current line."""
+
+        return len(self.__line) // 2
+
+    def __finish(self):
+        """
+        Finish the current line, or discard it if it's a singleton, dummy line.
+        """
+
+        if len(self.__line) > 2:
+            self.__finished.append(self.__line)
+            if self.__sink is not None:
+                self.__summarize()
+                line = Lines(self.coords, self.offsets)[-1]
+                del self.coords[:]
+                del self.offsets[1:]
+                self.__summarized = 0
+                self.__sink_placements()
+                self.__sink(line)
+
+    def __begin(self, x, y):
+        """Begin a new dummy line at the given point."""
+
+        self.__line = [x, y]
+        self.x = x
+        self.y = y
+
+    def __pack(self):
+        """Move the lines finished since last time into the packed buffers."""
+
+        finished = self.__finished
+        if not finished:
+            return
+        self.__finished = []
+        self.coords.fromlist(list(itertools.chain.from_iterable(finished)))
+        base = 2 * self.offsets[-1]
+        self.offsets.fromlist([(base + e) // 2 for e in itertools.accumulate(map(len, finished))])
+
+    def __summarize(self):
+        """Bring the summary of the finished lines up to date."""
+
+        self.__pack()
+        offsets = self.offsets
+        for i in range(self.__summarized, len(offsets) - 1):
+            self.__summary.add_coords(self.coords, offsets[i], offsets[i + 1])
+        self.__summarized = len(offsets) - 1
+
+    def packed(self):
+        """
+        Finish the current line (or discard it if it's a singleton, dummy line)
+        and return the untransformed lines, packed. These share the canvas's
+        buffers, so they're cheap to create, but will change as drawing
+        continues.
+        """
+
+        if self.__current() > 1:
+            self.__finish()
+            self.__begin(self.x, self.y)
+        if self.__sink is not None:
+            self.__sink_placements()
+
+        return self.__instanced()
+
+    def __instanced(self):
+        """
+        The finished lines along with any placed motifs – all of whose lines
+        count, since they're supposed to be done by the time they're placed.
+        """
+
+        self.__pack()
+        lines = Lines(self.coords, self.offsets)
+        if not self.__placements:
+            return lines
+
+        # each motif's lines are shared by all of its placements
+        motifs = {}
+        placements = []
+        for position, instance in self.__placements:
+            motif = instance.motif
+            if id(motif) not in motifs:
+                motifs[id(motif)] = motif.packed()
+            placements.append((position, motifs[id(motif)], compose(motif.matrix, instance.matrix)))
+        return InstancedLines(lines, placements)
+
+    @property
+    def lines(self):
+        """
+        The untransformed lines finished so far, leaving the current one be –
+        like packed, they share the canvas's buffers.
+        """
+
+        return self.__instanced()
+
+    @property
+    def summary(self):
+        """
+        Statistics of the drawing before any transformations (see Summary),
+        computed for the lines drawn since the last time it was asked for. Placed
+        motifs are accounted for by their own summaries, transformed into place
+        (see Summary.transformed), rather than by expanding them.
+        """
+
+        self.__summarize()
+        summary = copy.copy(self.__summary)
+        if self.__placements:
+            self.__add_placements(summary)
+
+        # the current line is accounted for without finishing it
+        if self.__current() > 1:
+            summary.add_coords(self.__line, 0, self.__current())
+        return summary
+
+    def __add_placements(self, summary):
+        """
+        Account for the placed motifs in the summary of the finished lines,
+        whose pen movements already lead from each line to the next one.
+        """
+
+        coords = self.coords
+        offsets = self.offsets
+        n = len(offsets) - 1
+        motifs = {}
+        for position, placements in itertools.groupby(self.__placements, key=operator.itemgetter(0)):
+            part = Summary()
+            for _, instance in placements:
+                motif = instance.motif
+                if id(motif) not in motifs:
+                    motifs[id(motif)] = motif.summary
+                part.add_summary(motifs[id(motif)].transformed(compose(motif.matrix, instance.matrix)))
+            if not part.lines:
+                continue
+
+            # the pen travels to the motifs and on from them instead of from
+            # the line before them to the one after them
+            before = (coords[2 * offsets[position] - 2], coords[2 * offsets[position] - 1]) if position else None
+            after = (coords[2 * offsets[position]], coords[2 * offsets[position] + 1]) if position < n else None
+            if before is not None and after is not None:
+                summary.pen_up -= math.dist(before, after)
+            if after is not None:
+                summary.pen_up += math.dist(part.end, after)
+            start = part.start if position == 0 else summary.start
+            end = part.end if position == n else summary.end
+            summary.end = before
+            summary.add_summary(part)
+            summary.start = start
+            summary.end = end
+
+    def place(self, motif):
+        """
+        Place another canvas, the motif, at this point of the drawing order
+        without copying its lines, which are only expanded once needed. Returns
+        the placement, which can be transformed (see Transformable) to move the
+        motif into position, e.g. c.place(motif).translate(x, y). The motif
+        shouldn't change anymore by the time this canvas is emitted. Drawing
+        continues from the current point, in a new line.
+        """
+
+        self.__m(self.x, self.y)
+        instance = Instance(motif)
+        self.__pack()
+        self.__placements.append((len(self.offsets) - 1, instance))
+        return instance
+
+    def __sink_placements(self):
+        """Hand the lines of the motifs placed so far to the sink, see stream."""
+
+        placements = self.__placements
+        self.__placements = []
+        for _, instance in placements:
+            motif = instance.motif
+            for l in transform_lines(motif.packed(), compose(motif.matrix, instance.matrix)):
+                self.__sink(l)
+
+    @profiled()
     def emit(self):
         """
         Finish the current line (or discard it if it's a singleton, dummy line)
-        and return the lines.
+        and return the (transformed) lines as a list of lists of points.
         """
 
-        if len(self.current_line) > 1:
-            self.lines.append(self.current_line)
-            self.current_line = [[self.x, self.y]]
-        return self.lines
+        lines = transform_lines(self.packed(), self.matrix)
+        return lines.tolist()
 
     def __m(self, x, y):
         """
@@ -187,19 +2744,67 @@ class Canvas:
         and move to the new point, beginning a dummy line at this location.
         """
 
-        if len(self.current_line) > 1:
-            self.lines.append(self.current_line)
-        self.x = x
-        self.y = y
-        self.current_line = [[self.x, self.y]]
+        self.__finish()
+        self.__begin(x, y)
 
     def __l(self, x, y):
         """Add a segment to the current line."""
 
-        self.current_line.append([x, y])
+        self.__line += (x, y)
         self.x = x
         self.y = y
 
+    def __path(self, xs, ys):
+        """
+        Add segments through the given points to the current line, all at once.
+        """
+
+        if not xs:
+            return
+
+        points = [0] * (2 * len(xs))
+        points[0::2] = xs
+        points[1::2] = ys
+        self.__line += points
+        self.x = xs[-1]
+        self.y = ys[-1]
+
+    def __lines(self, xs, ys, counts):
+        """
+        Add lines with the given numbers of points (at least two each), whose
+        coordinates are concatenated in xs and ys, all at once – with the same
+        result as moving to the first point of each and adding segments through
+        the others, so the last one remains the current line.
+        """
+
+        if not counts:
+            return
+
+        # a stream needs to be handed each line separately
+        if self.__sink is not None:
+            start = 0
+            for count in counts:
+                self.__m(xs[start], ys[start])
+                self.__path(xs[start + 1:start + count], ys[start + 1:start + count])
+                start += count
+            return
+
+        self.__finish()
+        self.__pack()
+        base = self.offsets[-1]
+        points = [0] * (2 * len(xs))
+        points[0::2] = xs
+        points[1::2] = ys
+
+        # all lines but the last one are finished
+        finished = 2 * (len(xs) - counts[-1])
+        self.coords.fromlist(points[:finished])
+        ends = itertools.accumulate(counts[:-1])
+        self.offsets.fromlist([base + e for e in ends])
+        self.__line = points[finished:]
+        self.x = xs[-1]
+        self.y = ys[-1]
+
     def move(self, x, y):
         """Move the pen without drawing."""
 
@@ -210,6 +2815,7 @@ class Canvas:
 
         self.__l(x, y)
 
+    @profiled(drawing=True)
     def rect(self, x0, y0, x1, y1):
         """Draw a rectangle specified by the x and y limits."""
 
@@ -229,13 +2835,35 @@ class Canvas:
         y = cy + r * math.sin(a)
         return [x, y]
 
-    def arc(self, cx, cy, r, s, e, detail=0.1):
+    @profiled(drawing=True)
+    def arc(self, cx, cy, r, s, e, detail=0.1, tolerance=None):
         """
         Draw an arc along the edge of an imaginary circle with radius r centered
         on point (cx, cy), with s and e (both in radians) being the start and
         end angle. If r is negative, the arc is drawn from the other end (this
-        can help avoid unnecessary pen movements).
+        can help avoid unnecessary pen movements). If a tolerance is given (here
+        or when creating the canvas), as few points as possible are used such
+        that the arc deviates from the ideal one by at most this distance,
+        otherwise there's a point every 1/detail degrees.
+        """
+
+        r, angles = self.__arc_angles(r, s, e, detail, tolerance)
+
+        # start point, intermediate points and end point
+        [x, y] = self.__xy(cx, cy, r, angles[0])
+        self.__m(x, y)
+        xs = [cx + r * math.cos(a) for a in angles[1:]]
+        ys = [cy + r * math.sin(a) for a in angles[1:]]
+        self.__path(xs, ys)
+
+    def __arc_angles(self, r, s, e, detail, tolerance):
         """
+        The (nonnegative) radius and the angles of the points of an arc, see
+        arc, from its start point to its end point.
+        """
+
+        if tolerance is None:
+            tolerance = self.tolerance
 
         cmp = lambda a: a < e
 
@@ -248,59 +2876,268 @@ class Canvas:
             e = tmp
             cmp = lambda a: a > e
 
-        def xy(a):
-            return self.__xy(cx, cy, r, a)
+        if tolerance is None:
+            increment = TAU / (360 * detail)
+            angles = [s]
+            a = s + increment
+            while cmp(a):
+                angles.append(a)
+                a += increment
+        else:
+            # the sagitta of a chord spanning angle step is r * (1 - cos(step/2))
+            step = 2 * math.acos(max(1 - tolerance / r, -1)) if r > 0 else TAU
+            n = max(1, math.ceil(abs(e - s) / min(step, TAU / 3)))
+            angles = [s] + [s + (e - s) * k / n for k in range(1, n)]
+        angles.append(e)
+        return r, angles
 
-        increment = TAU / (360 * detail)
+    @profiled(drawing=True)
+    def circle(self, cx, cy, r, detail=0.1, tolerance=None):
+        """Draw a circle with radius r around point (cx, cy)."""
 
-        # start point
-        [x, y] = xy(s)
-        self.__m(x, y)
+        self.arc(cx, cy, r, 0, TAU, detail, tolerance)
+
+    @profiled(drawing=True)
+    def spiral(self, cx, cy, w, j=1, detail=0.1, spacing=None):
+        """
+        Draw a spiral around point (cx, cy). w is the number of windings (not
+        necessarily a whole number), meanwhile j describes the jump/gap between
+        windings. If spacing is given, points are placed at this distance from
+        each other along the spiral, otherwise detail determines the number of
+        points per winding (with some relaxation towards the center).
+        """
 
-        # intermediate points
-        a = s + increment
-        while cmp(a):
-            [x, y] = xy(a)
-            self.__l(x, y)
-            a += increment
+        # start point, intermediate points and end point
+        self.__m(cx, cy)
+        rs, angles = self.__spiral_polar(w, j, detail, spacing)
+        xs = [cx + r * math.cos(a) for r, a in zip(rs, angles)]
+        ys = [cy + r * math.sin(a) for r, a in zip(rs, angles)]
+        self.__path(xs, ys)
 
-        # end point
-        [x, y] = xy(e)
-        self.__l(x, y)
+    def __spiral_polar(self, w, j, detail, spacing):
+        """
+        The radii and angles of the points of a spiral after its center, see
+        spiral.
+        """
 
-    def circle(self, cx, cy, r, detail=0.1):
-        """Draw a circle with radius r around point (cx, cy)."""
+        if spacing is None:
+            increment = 1 / (360 * detail)
+            ns = []
+            n = 0
+            while n < w:
+                ns.append(n)
+                #n += increment
+                n += increment / max(n / w, 0.2)  # relax increment in the middle
+            rs = [(n / w) * (j * w) for n in ns]
+            angles = [(n % 1) * TAU for n in ns]
+        else:
+            # the spiral is r = b * a, with arc length s(a) from the center to
+            # angle a; the angles at which the arc length is a multiple of the
+            # spacing are found with a newton iteration – if numpy is
+            # available, over all of them at once, starting at overestimates
+            # since s(a) >= b * a^2 / 2 (so it converges from above)
+            b = j / TAU
+            end = TAU * w
+            length = b / 2 * (end * math.sqrt(1 + end * end) + math.asinh(end))
+            n = max(1, math.ceil(length / spacing))
+
+            if numpy is not None:
+                targets = length * numpy.arange(1, n) / n
+                angles = numpy.sqrt(2 * targets / b)
+                for _ in range(50):
+                    root = numpy.sqrt(1 + angles * angles)
+                    steps = (b / 2 * (angles * root + numpy.arcsinh(angles)) - targets) / (b * root)
+                    angles -= steps
+                    if not len(steps) or steps.max() < 1e-12:
+                        break
+                rs = (b * angles).tolist()
+                angles = angles.tolist()
+            else:
+                # one target after the other instead, each starting from the
+                # previous angle extrapolated (to second order) by the spacing,
+                # which is close enough for a single step of halley's method
+                # (the third-order relative of newton's) to bring the error
+                # down to about the cube of the step, below 1e-12. In terms of
+                # t = 2 * s / b, which saves some multiplications
+                sqrt = math.sqrt
+                asinh = math.asinh
+                dt = 2 * length / n / b
+                angles = []
+                a = 0
+                root = 1
+                for k in range(1, n):
+                    t = dt * k
+                    r2 = root * root
+                    a += dt / (2 * root) - a * dt * dt / (8 * r2 * r2)
+                    delta = 1
+                    while abs(delta) >= 1e-4:
+                        root = sqrt(1 + a * a)
+                        f = a * root + asinh(a) - t
+                        delta = 2 * f * root / (4 * root * root - f * a / root)
+                        a -= delta
+                    angles.append(a)
+                rs = [b * a for a in angles]
 
-        self.arc(cx, cy, r, 0, TAU, detail)
+        rs.append(j * w)
+        angles.append((w % 1) * TAU)
+        return rs, angles
 
-    def spiral(self, cx, cy, w, j=1, detail=0.1):
+    # the bulk variants of the primitives above draw many shapes at once (given
+    # sequences, arrays or any other iterables of their parameters, which are
+    # only iterated once), exactly as if drawn one by one, but much faster:
+    # shapes with identical dimensions share their trigonometry, and the points
+    # of all of them are added in one go
+
+    @profiled(drawing=True)
+    def segments(self, x0s, y0s, x1s, y1s):
+        """Draw lines from (x0s[i], y0s[i]) to (x1s[i], y1s[i]) each."""
+
+        xs = [c for x0, x1 in zip(x0s, x1s) for c in (x0, x1)]
+        ys = [c for y0, y1 in zip(y0s, y1s) for c in (y0, y1)]
+        self.__lines(xs, ys, [2] * (len(xs) // 2))
+
+    @profiled(drawing=True)
+    def arcs(self, cxs, cys, rs, ss, es, detail=0.1, tolerance=None):
+        """Draw arcs with the given parameters each, see arc."""
+
+        shapes = {}
+        xs = []
+        ys = []
+        counts = []
+        for cx, cy, r, s, e in zip(cxs, cys, rs, ss, es):
+            shape = shapes.get((r, s, e))
+            if shape is None:
+                radius, angles = self.__arc_angles(r, s, e, detail, tolerance)
+                shape = shapes[r, s, e] = ([radius * math.cos(a) for a in angles],
+                                           [radius * math.sin(a) for a in angles])
+            dxs, dys = shape
+            xs.extend([cx + dx for dx in dxs])
+            ys.extend([cy + dy for dy in dys])
+            counts.append(len(dxs))
+        self.__lines(xs, ys, counts)
+
+    @profiled(drawing=True)
+    def circles(self, cxs, cys, rs, detail=0.1, tolerance=None):
+        """Draw circles with the given parameters each, see circle."""
+
+        self.arcs(cxs, cys, rs, itertools.repeat(0), itertools.repeat(TAU), detail, tolerance)
+
+    @profiled(drawing=True)
+    def spirals(self, cxs, cys, ws, js=None, detail=0.1, spacing=None):
+        """Draw spirals with the given parameters each, see spiral."""
+
+        shapes = {}
+        xs = []
+        ys = []
+        counts = []
+        for cx, cy, w, j in zip(cxs, cys, ws, itertools.repeat(1) if js is None else js):
+            shape = shapes.get((w, j))
+            if shape is None:
+                rs, angles = self.__spiral_polar(w, j, detail, spacing)
+                shape = shapes[w, j] = ([r * math.cos(a) for r, a in zip(rs, angles)],
+                                        [r * math.sin(a) for r, a in zip(rs, angles)])
+            dxs, dys = shape
+            xs.append(cx)
+            xs.extend([cx + dx for dx in dxs])
+            ys.append(cy)
+            ys.extend([cy + dy for dy in dys])
+            counts.append(len(dxs) + 1)
+        self.__lines(xs, ys, counts)
+
+    @profiled(drawing=True)
+    def hatch(self, shapes, spacing, angle=0):
         """
-        Draw a spiral around point (cx, cy). w is the number of windings (not
-        necessarily a whole number), meanwhile j describes the jump/gap between
-        windings.
+        Fill the area enclosed by the given closed polylines (lists of points,
+        e.g. lines of this or another canvas, whose last point needn't repeat
+        the first one) with parallel lines spacing apart at angle (in radians).
+        Areas enclosed by an even number of polylines, like holes, are left
+        empty. The hatch lines alternate in direction, such that the pen
+        zigzags across the area, and lie at multiples of spacing, such that
+        the hatching of adjacent areas lines up.
         """
 
-        def xy(r, a):
-            return self.__xy(cx, cy, r, a)
+        # in a frame rotated by -angle, hatch lines are horizontal, and each
+        # edge is stored as (lower y, upper y, x at lower y, dx/dy) – edges
+        # parallel to the hatch lines never cross them and are left out (which
+        # rounding errors of multiples of 90° would otherwise get in the way of)
+        cos = math.cos(angle)
+        sin = math.sin(angle)
+        cos = 0 if abs(cos) < 1e-15 else cos
+        sin = 0 if abs(sin) < 1e-15 else sin
+        edges = []
+        for shape in shapes:
+            points = [(x * cos + y * sin, y * cos - x * sin) for x, y in shape]
+            for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+                if y0 == y1:
+                    continue
+                if y0 > y1:
+                    x0, y0, x1, y1 = x1, y1, x0, y0
+                edges.append((y0, y1, x0, (x1 - x0) / (y1 - y0)))
+        if not edges:
+            return
+        edges.sort()
+        top = max(e[1] for e in edges)
 
-        increment = 1 / (360 * detail)
+        def spans(crossing, y):
+            """Pair up the crossings with the edges from left to right."""
 
-        # start point
-        self.__m(cx, cy)
+            xs = sorted([x + (y - low) * slope for low, _, x, slope in crossing])
+            return [(a, b) for a, b in zip(xs[0::2], xs[1::2]) if a < b]
 
-        # intermediate points
-        n = 0
-        while n < w:
-            r = (n / w) * (j * w)
-            a = (n % 1) * TAU
-            [x, y] = xy(r, a)
-            self.__l(x, y)
-            #n += increment
-            n += increment / max(n / w, 0.2)  # relax increment in the middle
-
-        # end point
-        [x, y] = xy(j * w, (w % 1) * TAU)
-        self.__l(x, y)
+        # sweep upwards, adding edges to the table once the hatch line reaches
+        # their lower end and dropping them once it's passed their upper end.
+        # Where a hatch line runs through vertices, the area just above it may
+        # differ from that just below it, and hatching only happens where it's
+        # inside on both sides, such that horizontal edges, like the top and
+        # bottom of a rectangle, aren't retraced
+        x0s, y0s, x1s, y1s = [], [], [], []
+        active = []
+        e = 0
+        row = 0
+        k = math.ceil(edges[0][0] / spacing)
+        while k * spacing < top:
+            y = k * spacing
+            while e < len(edges) and edges[e][0] <= y:
+                active.append(edges[e])
+                e += 1
+            active = [edge for edge in active if edge[1] >= y]
+            if not active:
+                k = max(k + 1, math.ceil(edges[e][0] / spacing))
+                continue
+
+            above = [edge for edge in active if edge[1] > y]
+            below = [edge for edge in active if edge[0] < y]
+            inside = spans(above, y)
+            if len(above) < len(active) or len(below) < len(active):
+                lower = spans(below, y)
+                both = []
+                i = j = 0
+                while i < len(inside) and j < len(lower):
+                    a = max(inside[i][0], lower[j][0])
+                    b = min(inside[i][1], lower[j][1])
+                    if a < b:
+                        # spans meeting at a vertex are hatched in one go
+                        if both and both[-1][1] == a:
+                            both[-1] = (both[-1][0], b)
+                        else:
+                            both.append((a, b))
+                    if inside[i][1] < lower[j][1]:
+                        i += 1
+                    else:
+                        j += 1
+                inside = both
+
+            if row % 2:
+                inside = [(b, a) for a, b in reversed(inside)]
+            for a, b in inside:
+                x0s.append(a * cos - y * sin)
+                y0s.append(a * sin + y * cos)
+                x1s.append(b * cos - y * sin)
+                y1s.append(b * sin + y * cos)
+            row += bool(inside)
+            k += 1
+
+        self.segments(x0s, y0s, x1s, y1s)
 
 def main():
     c = Canvas()
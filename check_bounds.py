@@ -0,0 +1,90 @@
+"""
+Checks that drawings cropped or fitted to bounds pass validation afterwards:
+some of the examples, and random segments crossing the edges of bounds all
+over, are blown up such that they spill out of various bounds, then cropped
+(with and without NumPy, if it's installed) or fitted to them, and none of
+their lines may be out of bounds or the arms' reach.
+
+python3 check_bounds.py
+"""
+
+import sys
+import random
+import argparse
+
+import brachiosaurus as bs
+import examples
+
+EXAMPLES = ["spiral_rose", "lines_boxes_arcs", "concentric_circles", "cog", "trojaborg_labyrinth_1", "ca"]
+
+# cropping only clips to bounds, so the arms must be able to reach all of them
+# – coordinates that aren't exactly representable make it likelier for
+# clipped points to be rounded to just outside of them
+CROP_BOUNDS = [None, [-5, 6, 5, 12], [-3.3, 7.1, 5.7, 11.9]]
+
+# besides the default bounds, an area whose center (the shoulder) is out of
+# reach and a thin strip partly out of reach
+FIT_BOUNDS = [None, [-20, -20, 20, 20], [-16, -1, 16, 1]]
+
+def crossings(c, n=2000):
+    """Draw n random segments, most of which cross the edges of bounds."""
+
+    c.segments(*([random.random() for _ in range(n)] for _ in range(4)))
+
+def spilling(canvas, bounds):
+    """
+    Return a plotter with the drawing centered on bounds, at three times their
+    size.
+    """
+
+    bxmin, bymin, bxmax, bymax = bounds or bs.BG_CONFIG["bounds"]
+    summary = canvas.summary
+    scale = 3 * max((bxmax - bxmin) / (summary.xmax - summary.xmin), (bymax - bymin) / (summary.ymax - summary.ymin))
+    return (bs.FakePlotter.from_canvas(canvas)
+                .translate(-(summary.xmin + summary.xmax) / 2, -(summary.ymin + summary.ymax) / 2)
+                .scale(scale)
+                .translate((bxmin + bxmax) / 2, (bymin + bymax) / 2))
+
+def check(name, canvas):
+    """Return a list of problems with cropping and fitting the drawing."""
+
+    problems = []
+    numpy = bs.numpy
+    for bounds in CROP_BOUNDS:
+        for bs.numpy in {numpy, None}:
+            try:
+                spilling(canvas, bounds).crop(bounds).validate(bounds)
+            except ValueError as e:
+                kind = "without" if bs.numpy is None else "with"
+                problems.append(f"{name} cropped to {bounds} {kind} numpy: {e}")
+    bs.numpy = numpy
+
+    for bounds in FIT_BOUNDS:
+        try:
+            spilling(canvas, bounds).fit(bounds).validate(bounds)
+        except ValueError as e:
+            problems.append(f"{name} fitted to {bounds}: {e}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.parse_args()
+
+    debug = bs.debug
+    bs.debug = lambda msg: None
+    problems = []
+    for name in EXAMPLES + ["crossings"]:
+        random.seed(42)
+        c = bs.Canvas()
+        getattr(examples, name, crossings)(c)
+        problems += check(name, c)
+    bs.debug = debug
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        sys.exit(1)
+    bs.debug(f"bounds: {len(EXAMPLES) + 1} drawings cropped and fitted, all fine")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Checks that hatching steps across gaps between shapes: blocks stacked with
+gaps narrower than the hatch spacing used to keep the sweep from ever moving
+on, so each hatching must finish in time, and fill both blocks.
+
+python3 check_hatch.py
+"""
+
+import sys
+import math
+import argparse
+import threading
+
+import brachiosaurus as bs
+
+# a gap whose edges round to the same hatch line
+BLOCKS = [
+    [(0, 0), (1, 0), (1, 6.65), (0, 6.65)],
+    [(0, 6.700000000000001), (1, 6.700000000000001), (1, 8), (0, 8)],
+    ]
+SPACING = 0.1
+
+def hatched(angle, timeout=5):
+    """
+    Return the hatch lines of the blocks at angle, or None if hatching them
+    doesn't finish within timeout seconds.
+    """
+
+    c = bs.Canvas()
+    done = threading.Event()
+
+    def hatch():
+        c.hatch(BLOCKS, SPACING, angle)
+        done.set()
+
+    threading.Thread(target=hatch, daemon=True).start()
+    if not done.wait(timeout):
+        return None
+    return c.emit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.parse_args()
+
+    problems = []
+    angles = [0, math.tau / 8, math.tau / 4]
+    for angle in angles:
+        lines = hatched(angle)
+        if lines is None:
+            problems.append(f"hatching at {angle:.3f} doesn't finish")
+            continue
+        ys = [y for l in lines for _, y in l]
+        if not lines or max(ys) <= BLOCKS[1][0][1] or min(ys) >= BLOCKS[0][2][1]:
+            problems.append(f"hatching at {angle:.3f} leaves a block empty")
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        sys.exit(1)
+    bs.debug(f"hatch: {len(angles)} angles, all fine")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Checks that ReplayPlotter drives the servos sensibly without needing an actual
+BrachioGraph: a stand-in for the brachiograph module records what would have
+been sent to the hardware while replaying a compiled drawing, and the pen must
+only ever come down after the arms have had time to arrive, but be down
+whenever a stroke is being drawn. Trajectories and drawings mustn't be loadable
+as one another, either.
+
+python3 check_replay.py
+"""
+
+import sys
+import time
+import types
+import itertools
+import argparse
+import tempfile
+
+import brachiosaurus as bs
+
+def stub_brachiograph(calls):
+    """
+    Return a module standing in for brachiograph, appending the calls made to
+    the plotter (and to time.sleep while replaying) to calls.
+    """
+
+    class Pen:
+        def up(self):
+            calls.append(("up",))
+
+        def down(self):
+            calls.append(("down",))
+
+    class BrachioGraph:
+        def __init__(self, **kwargs):
+            self.pen = Pen()
+
+        def set_pulse_widths(self, pw_1, pw_2):
+            calls.append(("move", pw_1, pw_2))
+
+        def park(self):
+            calls.append(("park",))
+
+    module = types.ModuleType("brachiograph")
+    module.BrachioGraph = BrachioGraph
+    return module
+
+def check(calls, strokes):
+    """Return a list of problems with the recorded calls, if any."""
+
+    problems = []
+    moves = [c[1:] for c in calls if c[0] == "move"]
+    expected = [tuple(pw) for stroke in strokes for pw in stroke]
+    if moves != expected:
+        problems.append("pulse widths don't match the compiled strokes")
+
+    # the pen may only come down once the arms have had as much time as they
+    # need to travel from where they were – the BrachioGraph software parks
+    # them when starting up
+    us_per_second = bs.SERVO_SPEED * abs(bs.BG_CONFIG.get("servo_1_degree_ms", -10))
+    parked = (bs.BG_CONFIG["servo_1_centre"], bs.BG_CONFIG["servo_2_centre"])
+    here = parked
+    travel = 0
+    down = False
+    starts = set(itertools.accumulate([0] + [len(stroke) for stroke in strokes]))
+    m = 0
+    for n, call in enumerate(calls):
+        if call[0] == "park":
+            here = parked
+            travel = 0
+        elif call[0] == "move":
+            if m not in starts and not down:
+                problems.append(f"call {n}: stroke drawn with the pen up")
+            m += 1
+            travel = max(abs(call[1] - here[0]), abs(call[2] - here[1])) / us_per_second
+            here = call[1:]
+        elif call[0] == "sleep":
+            travel -= call[1]
+        elif call[0] == "up":
+            down = False
+        elif call[0] == "down":
+            down = True
+            if travel > 1e-9:
+                problems.append(f"call {n}: pen down {travel:.3f}s before the arms arrive")
+    if calls[-2:] != [("up",), ("park",)]:
+        problems.append("pen isn't lifted and parked at the end")
+    return problems
+
+def mixups(trajectory, canvas):
+    """
+    Return a list of problems if trajectories can be loaded as drawings or
+    drawings as trajectories.
+    """
+
+    problems = []
+    try:
+        bs.FakePlotter.from_file(trajectory)
+        problems.append("a trajectory was loaded as a drawing")
+    except ValueError:
+        pass
+    with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+        bs.write_binary(canvas.packed(), f.name)
+        try:
+            bs.ReplayPlotter.from_file(f.name)
+            problems.append("a drawing was loaded as a trajectory")
+        except ValueError:
+            pass
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.parse_args()
+
+    calls = []
+    sys.modules["brachiograph"] = stub_brachiograph(calls)
+    sleep = time.sleep
+    time.sleep = lambda seconds: calls.append(("sleep", seconds))
+
+    # the first stroke starts where the arms are parked
+    c = bs.Canvas()
+    c.move(-bs.BG_CONFIG["inner_arm"], bs.BG_CONFIG["outer_arm"])
+    c.line(-4, 10)
+    c.rect(-4, 7, 0, 11)
+    c.circle(-2, 9, 1)
+    c.move(-6, 8)
+    c.line(2, 12)
+    problems = []
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".traj") as f:
+            bs.Plotter.from_canvas(c).compile(f.name)
+            plotter = bs.ReplayPlotter.from_file(f.name)
+            strokes = list(plotter.lines)
+            plotter.emit()
+            problems += mixups(f.name, c)
+    finally:
+        time.sleep = sleep
+
+    problems += check(calls, strokes)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        sys.exit(1)
+    bs.debug(f"replay: {len(strokes)} strokes, {len(calls)} calls, all fine")
+
+if __name__ == "__main__":
+    main()
@@ -364,10 +364,10 @@ def hatched_circle(c):
             c.move(x - r, y - r)
             c.line(-x - r, y - r)
 
-def ca(c):
+def ca(c, seed=42):
     """Elementary cellular automaton."""
 
-    random.seed(42)
+    random.seed(seed)
 
     # config
     rules = [11,26,30,57,60,90,106,150]
@@ -405,10 +405,8 @@ def ca(c):
         state = state2
         log.append(state2)
 
-    for y, st in enumerate(log):
-        for x, ce in enumerate(st):
-            if ce == "1":
-                c.circle(x, y, 0.5, 0.03)
+    cells = [(x, y) for y, st in enumerate(log) for x, ce in enumerate(st) if ce == "1"]
+    c.circles([x for x, _ in cells], [y for _, y in cells], [0.5] * len(cells), 0.03)
 
 def uji(c):
     """https://en.m.wikipedia.org/wiki/Uji_(Being-Time)"""
@@ -446,11 +444,15 @@ def moire_spirals(c):
     for i in range(4):
         c.spiral(0, i, 10, 1, 0.3)
 
-c = bs.Canvas()
+def main():
+    c = bs.Canvas()
 
-#uji(c)
-trojaborg_labyrinth_2(c)
+    #uji(c)
+    trojaborg_labyrinth_2(c)
 
-#plotter = bs.AutoPlotter().from_file("test-patterns/accuracy.json")
-plotter = bs.AutoPlotter().from_canvas(c)
-plotter.emit()
+    #plotter = bs.AutoPlotter().from_file("test-patterns/accuracy.json")
+    plotter = bs.AutoPlotter().from_canvas(c)
+    plotter.emit()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Renders seeded variants of drawings into a gallery of SVG previews, spread
+across all CPU cores, along with an index.html showing all of them:
+
+python3 gallery.py --seeds 0-19 lines_boxes_arcs radial_lines ca
+
+The drawings are looked up in examples.py (or the module given via --module)
+and drawn with the random module seeded with the variant's seed – or, if a
+drawing takes a seed argument, passed that instead. Variants are thus the same
+no matter which process renders them.
+"""
+
+import os
+import html
+import time
+import random
+import argparse
+import importlib
+import inspect
+import multiprocessing
+
+import brachiosaurus as bs
+
+def parse_seeds(spec):
+    """Parse a comma-separated list of seeds and ranges like 0-9."""
+
+    seeds = []
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        seeds.extend(range(int(first), int(last or first) + 1))
+    return seeds
+
+def render(task):
+    """
+    Draw a variant and write its preview to the output directory, return its
+    file name along with some statistics.
+    """
+
+    module, name, seed, output, detailed = task
+    draw = getattr(importlib.import_module(module), name)
+
+    start = time.perf_counter()
+    c = bs.Canvas()
+    if "seed" in inspect.signature(draw).parameters:
+        draw(c, seed=seed)
+    else:
+        random.seed(seed)
+        draw(c)
+    filename = f"{name}-{seed}.svg"
+    with open(os.path.join(output, filename), "w") as f:
+        bs.FakePlotter.from_canvas(c).emit(f, detailed)
+    return name, seed, filename, c.summary, time.perf_counter() - start
+
+def write_index(variants, filename):
+    """Write an HTML page showing the previews, one row per drawing."""
+
+    rows = {}
+    for name, seed, svg, summary, seconds in variants:
+        rows.setdefault(name, []).append(f"""
+    <figure>
+      <a href="{html.escape(svg)}"><img src="{html.escape(svg)}" loading="lazy"></a>
+      <figcaption>seed {seed}: {summary.lines} lines, {summary.points} points, pen-up length {summary.pen_up:.1f}</figcaption>
+    </figure>""")
+
+    with open(filename, "w") as f:
+        f.write("""<!DOCTYPE html>
+<meta charset="utf-8">
+<title>brachiosaurus gallery</title>
+<style>
+  body { font-family: sans-serif; }
+  section { display: flex; flex-wrap: wrap; gap: 1em; }
+  figure { margin: 0; width: 16em; }
+  img { width: 100%; height: 16em; object-fit: contain; border: 1px solid #ddd; }
+  figcaption { font-size: small; }
+</style>
+""")
+        for name, figures in rows.items():
+            f.write(f"<h2>{html.escape(name)}</h2>\n<section>{''.join(figures)}\n</section>\n")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--output", default="gallery", help="directory to write previews to")
+    parser.add_argument("--module", default="examples", help="module containing the drawings")
+    parser.add_argument("--seeds", default="0-9", help="seeds of the variants, e.g. 0-9 or 1,4,7")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--detailed", action="store_true", help="annotate every point")
+    parser.add_argument("drawings", nargs="+", help="drawings to render")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    tasks = [(args.module, name, seed, args.output, args.detailed)
+             for name in args.drawings
+             for seed in parse_seeds(args.seeds)]
+
+    # small tasks are handed out one by one such that no core runs dry while
+    # another one is still busy with a big chunk of them
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        variants = list(pool.imap(render, tasks, chunksize=1))
+    write_index(variants, os.path.join(args.output, "index.html"))
+
+    cpu = sum(v[4] for v in variants)
+    wall = time.perf_counter() - start
+    bs.debug(f"gallery: {len(variants)} variants in {wall:.2f}s ({cpu:.2f}s of drawing) "
+             f"at {os.path.join(args.output, 'index.html')}")
+
+if __name__ == "__main__":
+    main()